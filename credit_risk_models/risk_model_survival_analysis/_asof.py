@@ -0,0 +1,130 @@
+"""
+As-of aggregation of events, used to build point-in-time features.
+
+Instead of filtering the event table for each observation row, we sort
+events once per entity (e.g. a borrower or a loan) and answer all
+"how many events happened before the observation date" questions
+with cumulative sums and binary search.
+"""
+import numpy as np
+import pandas as pd
+
+
+class AsofIndex:
+    """Events sorted by key then date, answering as-of sums.
+
+    The events of each key are contiguous and sorted by date, so that a query
+    is answered with two binary searches and a difference of cumulative sums.
+    Building the index sorts the events once; it can then answer any number of
+    queries, e.g. one per lookback window.
+
+    Parameters
+    ----------
+    event_keys : array-like of shape (n_events,)
+        The entity of each event, e.g. the borrower_id.
+
+    event_dates : array-like of datetime of shape (n_events,)
+        The date of each event. Events with null dates are never counted.
+
+    weights : array-like of shape (n_events,), default=None
+        The value of each event. When None, count events instead.
+    """
+
+    def __init__(self, event_keys, event_dates, weights=None):
+        event_dates = pd.to_datetime(pd.Series(event_dates)).to_numpy("datetime64[ns]")
+
+        if weights is None:
+            weights = np.ones(event_dates.shape[0], dtype="int64")
+        else:
+            weights = np.asarray(weights)
+
+        # Null event dates are never "before" an observation date.
+        valid = ~np.isnat(event_dates)
+        codes, uniques = pd.factorize(np.asarray(event_keys)[valid])
+        self._keys = pd.Index(uniques)
+
+        # Replace dates by their rank among event dates, so that (key, date) fits
+        # in a single sortable int64.
+        event_times = event_dates[valid].view("int64")
+        self._times = np.unique(event_times)
+        self._n_times = self._times.shape[0] + 1
+        composite = codes * self._n_times + np.searchsorted(self._times, event_times)
+
+        order = np.argsort(composite, kind="stable")
+        self._composite = composite[order]
+        self._cumsum = np.concatenate(
+            [np.zeros(1, dtype=weights.dtype), np.cumsum(weights[valid][order])]
+        )
+
+    def sum(self, query_keys, query_dates, inclusive=False):
+        """Sum the weights of events sharing the query key and dated before the \
+        query date.
+
+        Parameters
+        ----------
+        query_keys : array-like of shape (n_queries,)
+            The entity of each query.
+
+        query_dates : array-like of datetime of shape (n_queries,)
+            The observation date of each query. Null dates and unknown keys
+            yield 0.
+
+        inclusive : bool, default=False
+            Whether to count events happening at the query date.
+
+        Returns
+        -------
+        sums : numpy.ndarray of shape (n_queries,)
+        """
+        query_dates = pd.to_datetime(pd.Series(query_dates)).to_numpy("datetime64[ns]")
+        query_codes = self._keys.get_indexer(np.asarray(query_keys))
+
+        # The number of distinct event dates before the query date: side="left"
+        # excludes events happening at the query date, "right" includes them.
+        side = "right" if inclusive else "left"
+        ranks = np.searchsorted(self._times, query_dates.view("int64"), side=side)
+
+        start = query_codes * self._n_times
+        upper = np.searchsorted(self._composite, start + ranks, side="left")
+        lower = np.searchsorted(self._composite, start, side="left")
+        sums = self._cumsum[upper] - self._cumsum[lower]
+
+        sums[(query_codes < 0) | np.isnat(query_dates)] = 0
+
+        return sums
+
+
+def asof_sum(
+    event_keys, event_dates, query_keys, query_dates, weights=None, inclusive=False
+):
+    """Sum event weights sharing the query key and dated before the query.
+
+    See AsofIndex, to answer several queries from the same events.
+
+    Parameters
+    ----------
+    event_keys : array-like of shape (n_events,)
+        The entity of each event, e.g. the borrower_id.
+
+    event_dates : array-like of datetime of shape (n_events,)
+        The date of each event. Events with null dates are never counted.
+
+    query_keys : array-like of shape (n_queries,)
+        The entity of each query.
+
+    query_dates : array-like of datetime of shape (n_queries,)
+        The observation date of each query. Null dates yield 0.
+
+    weights : array-like of shape (n_events,), default=None
+        The value of each event. When None, count events instead.
+
+    inclusive : bool, default=False
+        Whether to count events happening at the query date.
+
+    Returns
+    -------
+    sums : numpy.ndarray of shape (n_queries,)
+        int64 when counting events, the dtype of weights otherwise.
+    """
+    index = AsofIndex(event_keys, event_dates, weights=weights)
+    return index.sum(query_keys, query_dates, inclusive=inclusive)
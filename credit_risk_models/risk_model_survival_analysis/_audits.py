@@ -3,6 +3,40 @@ import pandas as pd
 from . import db
 from . import _utils
 
+# Audits without a loan can't be joined to observations, so they are filtered
+# out by the warehouse.
+AUDITS_SPEC = db.QuerySpec(
+    table="cars_carcollateralaudits",
+    columns=(
+        "id",
+        "loanid",
+        "collateralid",
+        "scheduledfor_from",
+        "scheduledfor_to",
+        "cancellation_takenat",
+        "submission_takenat",
+        "approval_result",
+        "approval_takenat",
+        "state",
+    ),
+    filters=("loanid IS NOT NULL",),
+)
+
+# Also read by _automative._get_collateral, so that both share a single fetch.
+DD_SPEC = db.QuerySpec(
+    table="cars_carcollateralduediligences",
+    columns=(
+        "id",
+        "collateralid",
+        "createdat",
+        "duedate",
+        "submission_takenat",
+        "carsource_companyinfo_companytype",
+        "state",
+        "approved",
+    ),
+)
+
 
 def get_audits():
     """Fetch audits.
@@ -47,21 +81,22 @@ def get_audits():
             200 is rejected and 300 is cancelled.
             Warning, this value can change and only reflects the last state.
     """
-    query = """
-        select
-            id as audit_id,
-            loanid as carloan_id,
-            collateralid as collateral_id,
-            scheduledfor_from as audit_scheduled_for_from,
-            scheduledfor_to as audit_due_date,
-            cancellation_takenat as audit_cancellation_date,
-            submission_takenat as audit_submission_date, 
-            approval_result as audit_approval_result,
-            approval_takenat as audit_approval_date,
-            state as audit_state
-        from cars_carcollateralaudits
-    """
-    audits = db.DBSourceWH().fetch(query)
+    columns_renaming = {
+        "id": "audit_id",
+        "loanid": "carloan_id",
+        "collateralid": "collateral_id",
+        "scheduledfor_from": "audit_scheduled_for_from",
+        "scheduledfor_to": "audit_due_date",
+        "cancellation_takenat": "audit_cancellation_date",
+        "submission_takenat": "audit_submission_date",
+        "approval_result": "audit_approval_result",
+        "approval_takenat": "audit_approval_date",
+        "state": "audit_state",
+    }
+    # This is one of the largest tables, stream it to bound memory.
+    audits = db.DBSourceWH().fetch(
+        AUDITS_SPEC.query, columns_renaming, chunksize=db.CHUNKSIZE
+    )
 
     # Remove the timezone
     cols = "audit_submission_date", "audit_cancellation_date", "audit_approval_date"
@@ -108,20 +143,17 @@ def get_dd():
     car_source : int
     dd_state : int
     """
-    query = """
-        select
-            id as dd_id,
-            collateralid as collateral_id,
-            createdat as dd_created_at,
-            duedate as dd_due_date,
-            submission_takenat as dd_submission_taken_at,
-            carsource_companyinfo_companytype as car_source,
-            state as dd_state,
-            approved as dd_approved
-
-        from cars_carcollateralduediligences
-    """
-    dd = db.DBSourceWH().fetch(query)
+    columns_renaming = {
+        "id": "dd_id",
+        "collateralid": "collateral_id",
+        "createdat": "dd_created_at",
+        "duedate": "dd_due_date",
+        "submission_takenat": "dd_submission_taken_at",
+        "carsource_companyinfo_companytype": "car_source",
+        "state": "dd_state",
+        "approved": "dd_approved",
+    }
+    dd = db.DBSourceWH().fetch(DD_SPEC.query, columns_renaming)
 
     # Remove the timezone
     for col in "dd_submission_taken_at", "dd_due_date":
@@ -1,6 +1,8 @@
 import pandas as pd
 
 from . import db
+from . import _audits
+from . import _loans
 
 
 def get_automative():
@@ -32,7 +34,7 @@ def get_automative():
 
 
 def _get_loan():
-    query = "SELECT * FROM cars_carloans"
+    query = _loans.CAR_LOANS_SPEC.query
     columns_renaming = {
         "id": "carloan_id",
         "borrowerid": "borrower_id",
@@ -41,7 +43,7 @@ def _get_loan():
         "principal_amount": "loan_amount",
         "principal_currency": "currency",
     }
-    loan = db.DBSourceWH().fetch(query, columns_renaming)
+    loan = db.DBSourceWH().fetch(query, columns_renaming, method="copy")
 
     # Created in days not in ns timezone
     loan["created_at"] = (
@@ -53,7 +55,7 @@ def _get_loan():
 
 
 def _get_collateral():
-    query = "SELECT * from cars_carcollateralduediligences"
+    query = _audits.DD_SPEC.query
     columns_renaming = {
         "collateralid": "collateral_id",
         "carsource_companyinfo_companytype": "car_source",
@@ -63,7 +65,7 @@ def _get_collateral():
 
 
 def _get_car():
-    query = "SELECT * from car_loan_status"
+    query = _loans.CAR_LOAN_STATUS_SPEC.query
     cols = [
         "carloan_id",
         "car_make",
@@ -71,7 +73,7 @@ def _get_car():
         "car_transmission_type",
         "car_first_registration_date",
     ]
-    car = db.DBSourceWH().fetch(query)[cols]
+    car = db.DBSourceWH().fetch(query, method="copy")[cols]
 
     # FIXME: How do we get the age of the car?
     # We need to find this information in cars_cars, but there isn't a good
@@ -0,0 +1,301 @@
+"""
+Caches of warehouse query results.
+
+- QueryCache persists query results on disk. Each query result is stored as an
+  uncompressed Arrow (Feather) file, so that reloading a table only converts its
+  columns, without parsing or decompressing them.
+- MemoryQueryCache shares query results in memory within a run, so that tables
+  read by several loaders are fetched once.
+"""
+import json
+import hashlib
+import threading
+from time import time
+from pathlib import Path
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
+
+from . import _logs
+
+
+class _QueryLocksMixin:
+    """Per-query locks, so that a query is only fetched by one thread at a time.
+    """
+
+    @contextmanager
+    def lock(self, query):
+        with _LOCKS_LOCK:
+            if not hasattr(self, "_locks"):
+                self._locks = {}
+            lock = self._locks.setdefault(_normalize(query), threading.Lock())
+        with lock:
+            yield
+
+
+_LOCKS_LOCK = threading.Lock()
+
+
+@dataclass
+class QueryCache(_QueryLocksMixin, _logs.LogsMixin):
+    """Persist query results on disk, keyed by query text and cache date.
+
+    Parameters
+    ----------
+    cache_dir : str, default=".warehouse_cache"
+        The directory where the tables are stored.
+
+    ttl_hours : float, default=24
+        The time to live of a cached table. Tables older than this are
+        fetched again. If None, tables never expire.
+
+    cache_date : str, default=None
+        Part of the key, to keep snapshots of the warehouse apart.
+        If None, use the current date, so that tables are fetched at least
+        once per day.
+    """
+
+    cache_dir: str = ".warehouse_cache"
+    ttl_hours: float | None = 24
+    cache_date: str | None = None
+
+    def __post_init__(self):
+        if self.cache_date is None:
+            self.cache_date = pd.Timestamp.now().strftime("%Y-%m-%d")
+        Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
+
+    def load(self, query, columns=None):
+        """Load a cached query result.
+
+        Parameters
+        ----------
+        query : str
+            The SQL query.
+
+        columns : list of str, default=None
+            The columns to read. If None, read all columns.
+
+        Returns
+        -------
+        df : pandas.DataFrame or None
+            None when the query is not cached or expired.
+        """
+        path, meta_path = self._paths(query)
+        if not path.exists() or not meta_path.exists():
+            return None
+
+        meta = json.loads(meta_path.read_text())
+        age_hours = (time() - meta["created_at"]) / 3600
+        if self.ttl_hours is not None and age_hours > self.ttl_hours:
+            self._remove(query)
+            self._log_info("expired", path.name, f"-- {age_hours:.1f}h old")
+            return None
+
+        table = feather.read_table(path, columns=columns)
+        self._log_info("loaded", path.name)
+        return table.to_pandas()
+
+    def save(self, query, df, elapsed=None):
+        """Store a query result.
+
+        Tables that Arrow can't serialize are not cached.
+
+        Parameters
+        ----------
+        query : str
+            The SQL query.
+
+        df : pandas.DataFrame
+            The query result.
+
+        elapsed : float, default=None
+            The time it took to fetch the query result, in seconds.
+        """
+        path, meta_path = self._paths(query)
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+        except (pa.ArrowException, TypeError) as e:
+            self._log_info("skipped", path.name, f"-- {e}")
+            return
+
+        # Write to a temporary file first, so that a concurrent reader never sees
+        # a partial table.
+        tmp_path = path.with_suffix(".tmp")
+        feather.write_feather(table, tmp_path, compression="uncompressed")
+        tmp_path.replace(path)
+        meta_path.write_text(
+            json.dumps(
+                dict(
+                    query=query,
+                    cache_date=self.cache_date,
+                    created_at=time(),
+                    elapsed=elapsed,
+                )
+            )
+        )
+        self._log_info("saved", path.name)
+
+    def invalidate(self, query=None):
+        """Remove a cached query result, or all of them when query is None.
+        """
+        if query is not None:
+            self._remove(query)
+            return
+
+        for path in Path(self.cache_dir).glob("*.arrow"):
+            path.unlink(missing_ok=True)
+            path.with_suffix(".json").unlink(missing_ok=True)
+        self._log_info("invalidated", self.cache_dir)
+
+    def _remove(self, query):
+        for path in self._paths(query):
+            path.unlink(missing_ok=True)
+
+    def _paths(self, query):
+        key = hashlib.sha256(
+            f"{self.cache_date}\n{_normalize(query)}".encode()
+        ).hexdigest()
+        path = Path(self.cache_dir) / f"{key}.arrow"
+        return path, path.with_suffix(".json")
+
+
+@dataclass
+class MemoryQueryCache(_QueryLocksMixin, _logs.LogsMixin):
+    """Share query results in memory, within a run.
+
+    Cached dataframes are shared between loaders: they are returned as shallow
+    copies and must not be modified inplace. A query result is only kept in
+    memory until it has been read by the number of loaders registered with
+    set_readers, 1 by default, so that results read by a single loader are never
+    kept.
+
+    Parameters
+    ----------
+    backend : QueryCache, default=None
+        An on-disk cache, used on in-memory misses and updated on saves.
+    """
+
+    backend: QueryCache | None = None
+
+    def __post_init__(self):
+        self._tables = {}
+        self._n_readers = {}
+        self._n_reads = Counter()
+        self._stats = Counter()
+
+    def set_readers(self, query, n_readers):
+        """Keep the result of a query in memory until n_readers loaders read it.
+
+        Parameters
+        ----------
+        query : str
+            The SQL query.
+
+        n_readers : int
+            The number of loaders reading the query, including the one fetching
+            it.
+        """
+        self._n_readers[_normalize(query)] = n_readers
+
+    def load(self, query, columns=None):
+        """Load a query result from memory, or from the backend.
+
+        Parameters
+        ----------
+        query : str
+            The SQL query.
+
+        columns : list of str, default=None
+            The columns to return. If None, return all columns.
+
+        Returns
+        -------
+        df : pandas.DataFrame or None
+            None when the query is not cached.
+        """
+        key = _normalize(query)
+        if key not in self._tables:
+            df = None if self.backend is None else self.backend.load(query)
+            if df is None:
+                self._stats["n_misses"] += 1
+                return None
+            self._store(key, df, elapsed=0)
+
+        df, column_bytes, elapsed = self._tables[key]
+        self._consume(key)
+        if columns is None:
+            df = df.copy(deep=False)
+        else:
+            df = df[columns]
+            column_bytes = column_bytes[columns]
+
+        self._stats["n_hits"] += 1
+        self._stats["bytes_saved"] += int(column_bytes.sum())
+        self._stats["seconds_saved"] += elapsed
+        return df
+
+    def save(self, query, df, elapsed=None):
+        """Store a query result in memory, and in the backend.
+
+        Parameters
+        ----------
+        query : str
+            The SQL query.
+
+        df : pandas.DataFrame
+            The query result.
+
+        elapsed : float, default=None
+            The time it took to fetch the query result, in seconds.
+        """
+        key = _normalize(query)
+        self._store(key, df, elapsed or 0)
+        # The loader fetching the query is its first reader.
+        self._consume(key)
+        if self.backend is not None:
+            self.backend.save(query, df, elapsed=elapsed)
+
+    def invalidate(self, query=None):
+        """Remove a query result, or all of them when query is None, from \
+        memory and from the backend.
+        """
+        if query is None:
+            self._tables.clear()
+            self._n_reads.clear()
+        else:
+            self._evict(_normalize(query))
+
+        if self.backend is not None:
+            self.backend.invalidate(query)
+
+    def get_stats(self):
+        """Return the number of hits and misses, and the bytes and seconds \
+        saved by the hits.
+        """
+        stats = dict(n_hits=0, n_misses=0, bytes_saved=0, seconds_saved=0.0)
+        stats.update(self._stats)
+        return stats
+
+    def _store(self, key, df, elapsed):
+        column_bytes = df.memory_usage(index=False, deep=True)
+        self._tables[key] = (df, column_bytes, elapsed)
+
+    def _consume(self, key):
+        self._n_reads[key] += 1
+        if self._n_reads[key] >= self._n_readers.get(key, 1):
+            self._evict(key)
+            # Later reads are not expected, unless registered again.
+            self._n_readers.pop(key, None)
+
+    def _evict(self, key):
+        self._tables.pop(key, None)
+        self._n_reads.pop(key, None)
+
+
+def _normalize(query):
+    # Whitespace differences don't change the result of a query.
+    return " ".join(query.split())
@@ -41,7 +41,8 @@ def _get_company_data():
         "countrycode": "country_code",
         "foundingdate": "founding_date",
     }
-    query = "SELECT * FROM cars_companies"
+    spec = db.QuerySpec(table="cars_companies", columns=tuple(columns_renaming))
+    query = spec.query
     companies = db.DBSourceWH().fetch(query, columns_renaming)
 
     companies = companies.replace("-", None)
@@ -66,7 +67,8 @@ def _get_owner():
         "id": "borrower_id",
         "ownerpersonaldata_birthdate": "owner_birthdate",
     }
-    query = "SELECT * from plafond_companies"
+    spec = db.QuerySpec(table="plafond_companies", columns=tuple(columns_renaming))
+    query = spec.query
     owner = db.DBSourceWH().fetch(query, columns_renaming)
 
     owner["owner_birthdate"] = pd.to_datetime(
@@ -87,7 +89,10 @@ def _get_credit_limit():
         "companyid": "borrower_id",
         "grantedamount_amount": "credit_limit",
     }
-    query = "SELECT * FROM plafond_companyplafondledger"
+    spec = db.QuerySpec(
+        table="plafond_companyplafondledger", columns=tuple(columns_renaming)
+    )
+    query = spec.query
     credit = db.DBSourceWH().fetch(query, columns_renaming)
 
     credit["credit_limit"] = credit["credit_limit"].astype("int32")
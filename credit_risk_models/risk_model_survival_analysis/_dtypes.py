@@ -0,0 +1,167 @@
+"""
+Compact dtypes for the tables of DatasetMaker.
+
+Ids and low-cardinality strings are stored as Arrow-backed strings instead of
+Python objects, and the features with the dtypes of SCHEMA. Dtypes only depend
+on the names of the columns, never on their values, so that all the chunks of a
+dataset have the same dtypes and their Parquet files can be read back together.
+"""
+import re
+from dataclasses import dataclass
+
+import pandas as pd
+import pyarrow as pa
+
+# Low-cardinality string columns. They are not stored as categories, whose codes
+# and categories would depend on the values of each chunk.
+STRING_COLS = [
+    "car_make",
+    "car_model",
+    "car_transmission_type",
+    "car_source",
+    "country_code",
+]
+
+# The dtype of the numeric features. Counts are int32, and columns that can be
+# missing after a left join are float32.
+SCHEMA = {
+    "loan_age_days": "int32",
+    "loan_amount": "float32",
+    "n_days_since_founded": "float32",
+    "owner_age_year": "float32",
+    "loan_n_past_audits": "int32",
+    "loan_n_audit_overdue": "int32",
+    "loan_n_audit_approved": "int32",
+    "loan_n_audit_rejected": "int32",
+    "loan_ratio_audit_overdue": "float32",
+    "loan_ratio_audit_approved": "float32",
+    "loan_ratio_audit_rejected": "float32",
+    "dealer_n_past_audits": "int32",
+    "dealer_n_audit_overdue": "int32",
+    "dealer_n_audit_approved": "int32",
+    "dealer_n_audit_rejected": "int32",
+    "dealer_ratio_audit_overdue": "float32",
+    "dealer_ratio_audit_approved": "float32",
+    "dealer_ratio_audit_rejected": "float32",
+    "dealer_n_cars_financed": "int32",
+    "dealer_avg_reimbursment_days": "float32",
+    "dealer_n_cars_reimbursed": "int32",
+    "dealer_n_maturity_reached": "int32",
+    "dealer_n_cars_sold_np": "int32",
+    "dealer_n_loan_ongoing": "int32",
+    "dealer_ratio_reimbursed": "float32",
+    "dealer_ratio_maturity_reached": "float32",
+    "dealer_ratio_cars_sold_np": "float32",
+}
+
+# The suffix of the features over a lookback window, see _feature_registry.
+_WINDOW_SUFFIX = re.compile(r"_\d+d$")
+
+
+@dataclass
+class DtypePolicy:
+    """How to compact the dtypes of a table.
+
+    Parameters
+    ----------
+    strings : str or None, default="string[pyarrow]"
+        The dtype of string ids (columns ending with "_id") and of the string
+        columns of STRING_COLS. If None, keep them.
+
+    schema : dict of str, default=None
+        The dtype of each numeric column, by name. Features over a lookback
+        window, e.g. <name>_30d, have the dtype of <name>. Other columns are
+        kept. If None, use SCHEMA.
+    """
+
+    strings: str | None = "string[pyarrow]"
+    schema: dict | None = None
+
+    def apply(self, df):
+        """Return df with compact dtypes.
+
+        Parameters
+        ----------
+        df : pandas.DataFrame
+
+        Returns
+        -------
+        df : pandas.DataFrame
+        """
+        schema = SCHEMA if self.schema is None else self.schema
+        dtypes = {}
+        for col, dtype in df.dtypes.items():
+            is_string = pd.api.types.is_object_dtype(dtype) or (
+                pd.api.types.is_string_dtype(dtype)
+                and not isinstance(dtype, pd.CategoricalDtype)
+            )
+            if is_string and (col.endswith("_id") or col in STRING_COLS):
+                # Object columns can hold non-string ids, e.g. Decimal.
+                is_string = pd.api.types.infer_dtype(df[col], skipna=True) in (
+                    "string", "empty"
+                )
+                if is_string and self.strings is not None:
+                    dtypes[col] = self.strings
+                continue
+
+            name = _WINDOW_SUFFIX.sub("", col)
+            if name in schema:
+                dtypes[col] = schema[name]
+
+        return df.astype(dtypes)
+
+
+def get_arrow_schema(df):
+    """Return the Arrow schema to write all the chunks of a dataset with, from
+    its first chunk.
+
+    Columns missing in the whole chunk have no type in Arrow, and are assumed to
+    be strings. Integer columns that are float in SCHEMA, because they can be
+    missing after a left join, are stored as floats.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The first chunk.
+
+    Returns
+    -------
+    schema : pyarrow.Schema
+    """
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    for idx, field in enumerate(schema):
+        dtype = SCHEMA.get(_WINDOW_SUFFIX.sub("", field.name), "")
+        if pa.types.is_null(field.type):
+            schema = schema.set(idx, field.with_type(pa.string()))
+        elif pa.types.is_integer(field.type) and dtype.startswith("float"):
+            schema = schema.set(idx, field.with_type(pa.float64()))
+    return schema
+
+
+def memory_report(tables):
+    """Return the memory used by each table.
+
+    Parameters
+    ----------
+    tables : dict of pandas.DataFrame
+        The tables, by name.
+
+    Returns
+    -------
+    report : pandas.DataFrame
+        The number of rows and columns, and the memory in MB of each table,
+        including Python objects.
+    """
+    report = pd.DataFrame(
+        [
+            dict(
+                table=name,
+                n_rows=df.shape[0],
+                n_cols=df.shape[1],
+                memory_mb=df.memory_usage(index=True, deep=True).sum() / 1024 ** 2,
+            )
+            for name, df in tables.items()
+        ],
+        columns=["table", "n_rows", "n_cols", "memory_mb"],
+    )
+    return report.set_index("table")
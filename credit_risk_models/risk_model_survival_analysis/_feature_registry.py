@@ -0,0 +1,391 @@
+"""
+Declarative point-in-time features.
+
+Each feature aggregates the events of a table (audits or loans) per entity (a loan
+or a dealer), over lookback windows ending at the observation date. An event
+contributes from its date, and only when it matches the feature predicate.
+
+Features sharing a table and an entity are computed in a single as-of pass: their
+events are stacked and sorted once, and each feature and window is then a couple
+of binary searches. Adding windows to a feature, e.g. windows=(None, 30, 90),
+adds the columns <name>_30d and <name>_90d.
+"""
+from dataclasses import dataclass
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+
+from . import _asof
+from . import _loans
+
+# The column identifying each entity, in both the observations and the events.
+ENTITY_KEYS = {"loan": "carloan_id", "dealer": "borrower_id"}
+
+
+@dataclass(frozen=True)
+class EventFeature:
+    """A point-in-time aggregation of events per entity.
+
+    Parameters
+    ----------
+    name : str
+        The name of the feature.
+
+    entity : {"loan", "dealer"}
+        The entity whose events are aggregated.
+
+    table : {"audits", "loans"}
+        The event table.
+
+    date : callable
+        Return the date from which each event is observed, from the event table.
+        Events with null dates are never aggregated.
+
+    predicate : callable, default=None
+        Return whether each event is aggregated, from the event table.
+        If None, aggregate all events.
+
+    aggregation : {"count", "sum"}, default="count"
+        Whether to count events or sum their values.
+
+    value : callable, default=None
+        Return the value of each event, when aggregation="sum".
+
+    windows : tuple of int or None, default=(None,)
+        The lookback windows, in days. None aggregates all the history and keeps
+        the name of the feature, other windows add a "_<days>d" suffix.
+
+    inclusive : bool, default=False
+        Whether to aggregate events happening at the observation date.
+    """
+
+    name: str
+    entity: str
+    table: str
+    date: Callable
+    predicate: Callable | None = None
+    aggregation: str = "count"
+    value: Callable | None = None
+    windows: tuple = (None,)
+    inclusive: bool = False
+
+    @property
+    def columns(self):
+        return [
+            self.name if window is None else f"{self.name}_{window}d"
+            for window in self.windows
+        ]
+
+    def get_dates(self, events):
+        dates = pd.to_datetime(self.date(events))
+        if self.predicate is not None:
+            dates = dates.where(self.predicate(events).astype(bool))
+        return dates
+
+    def get_weights(self, events):
+        if self.aggregation == "count":
+            return None
+        return self.value(events).fillna(0).astype("float64")
+
+
+def _is_active(audits):
+    return ~audits["audit_cancelled"].astype(bool)
+
+
+def _is_overdue(audits):
+    # An audit is overdue when it hasn't been submitted before its due date and
+    # is not cancelled. It is observed from its due date.
+    is_submitted_on_time = audits["audit_submission_date"] < audits["audit_due_date"]
+    return ~is_submitted_on_time & _is_active(audits)
+
+
+def _get_decision_date(audits):
+    # Approvals and rejections require both the "scheduled from" and the submission
+    # dates to be observed.
+    past_date = audits["audit_scheduled_for_from"].where(_is_active(audits))
+    return past_date.where(
+        past_date > audits["audit_submission_date"],
+        audits["audit_submission_date"],
+    ).where(past_date.notnull())
+
+
+def _get_reimbursment_days(loans):
+    # Null dates are not taken into account in the average.
+    return (loans["loan_reimbursed_date"] - loans["loan_created_date"]).dt.days
+
+
+def _get_closed_date(loans):
+    # A loan is on-going when we haven't observed the end date yet.
+    created_date, end_date = loans["loan_created_date"], loans["loan_end_date"]
+    return end_date.where(end_date > created_date, created_date).where(
+        end_date.notnull() & created_date.notnull()
+    )
+
+
+def _has_risk(risk):
+    return lambda loans: loans["risks"] == risk
+
+
+FEATURES = [
+    # Audits of the loan. Past audits are those whose "scheduled from" date we
+    # can observe.
+    EventFeature(
+        "loan_n_past_audits", "loan", "audits",
+        date=lambda audits: audits["audit_scheduled_for_from"],
+        predicate=_is_active,
+        inclusive=True,
+    ),
+    EventFeature(
+        "loan_n_audit_overdue", "loan", "audits",
+        date=lambda audits: audits["audit_due_date"],
+        predicate=_is_overdue,
+    ),
+    EventFeature(
+        "loan_n_audit_approved", "loan", "audits",
+        date=lambda audits: audits["audit_submission_date"],
+        predicate=lambda audits: audits["audit_approved"],
+    ),
+    EventFeature(
+        "loan_n_audit_rejected", "loan", "audits",
+        date=lambda audits: audits["audit_submission_date"],
+        predicate=lambda audits: audits["audit_rejected"],
+    ),
+    # Audits of all the loans of the dealer.
+    EventFeature(
+        "dealer_n_past_audits", "dealer", "audits",
+        date=lambda audits: audits["audit_scheduled_for_from"],
+        predicate=_is_active,
+    ),
+    EventFeature(
+        "dealer_n_audit_overdue", "dealer", "audits",
+        date=lambda audits: audits["audit_due_date"],
+        predicate=_is_overdue,
+    ),
+    EventFeature(
+        "dealer_n_audit_approved", "dealer", "audits",
+        date=_get_decision_date,
+        predicate=lambda audits: audits["audit_approved"],
+    ),
+    EventFeature(
+        "dealer_n_audit_rejected", "dealer", "audits",
+        date=_get_decision_date,
+        predicate=lambda audits: audits["audit_rejected"],
+    ),
+    # Loans of the dealer. dealer_sum_reimbursment_days, dealer_n_reimbursment_days
+    # and dealer_n_loan_closed are intermediate, see
+    # _make_dataset._add_labels_ratios.
+    EventFeature(
+        "dealer_n_cars_financed", "dealer", "loans",
+        date=lambda loans: loans["loan_created_date"],
+    ),
+    EventFeature(
+        "dealer_sum_reimbursment_days", "dealer", "loans",
+        date=lambda loans: loans["loan_reimbursed_date"],
+        predicate=lambda loans: _get_reimbursment_days(loans).notnull(),
+        aggregation="sum",
+        value=_get_reimbursment_days,
+    ),
+    EventFeature(
+        "dealer_n_reimbursment_days", "dealer", "loans",
+        date=lambda loans: loans["loan_reimbursed_date"],
+        predicate=lambda loans: _get_reimbursment_days(loans).notnull(),
+    ),
+    EventFeature(
+        "dealer_n_cars_reimbursed", "dealer", "loans",
+        date=lambda loans: loans["loan_end_date"],
+        predicate=_has_risk(_loans.Risks.reimbursed),
+    ),
+    EventFeature(
+        "dealer_n_maturity_reached", "dealer", "loans",
+        date=lambda loans: loans["loan_end_date"],
+        predicate=_has_risk(_loans.Risks.maturity_reached),
+    ),
+    EventFeature(
+        "dealer_n_cars_sold_np", "dealer", "loans",
+        date=lambda loans: loans["loan_end_date"],
+        predicate=_has_risk(_loans.Risks.car_sold_np),
+    ),
+    EventFeature(
+        "dealer_n_loan_closed", "dealer", "loans",
+        date=_get_closed_date,
+    ),
+]
+
+
+def get_features(table, entity, features=None):
+    """Return the features aggregating a table per entity.
+    """
+    features = FEATURES if features is None else features
+    return [
+        feature for feature in features
+        if feature.table == table and feature.entity == entity
+    ]
+
+
+def get_window_columns(features=None):
+    """Return the columns of the features over finite lookback windows, e.g.
+    <name>_30d, which are added to the dataset as they are.
+    """
+    features = FEATURES if features is None else features
+    return [
+        col
+        for feature in features
+        for window, col in zip(feature.windows, feature.columns)
+        if window is not None
+    ]
+
+
+class EventIndex:
+    """The events of a table, sorted per entity for all the features aggregating
+    them.
+
+    The index is built once, e.g. per DatasetMaker, and answers the as-of queries
+    of any observations: the event dates, the predicates and the sort are not
+    evaluated again.
+
+    Parameters
+    ----------
+    events : pandas.DataFrame
+        The event table, with the entity key.
+
+    table : {"audits", "loans"}
+        The name of the event table.
+
+    entity : {"loan", "dealer"}
+        The entity to aggregate events per.
+
+    features : list of EventFeature, default=None
+        If None, use FEATURES.
+    """
+
+    def __init__(self, events, table, entity, features=None):
+        self.features = get_features(table, entity, features)
+        self.key = ENTITY_KEYS[entity]
+
+        # Stack the events of all features, keyed by (feature, entity), so that
+        # they are sorted once. Events without entity are dropped.
+        codes, uniques = pd.factorize(events[self.key].to_numpy())
+        self._keys = pd.Index(uniques)
+        self._n_codes = uniques.shape[0]
+        has_key = codes >= 0
+
+        event_keys, event_dates, event_weights = [], [], []
+        for idx, feature in enumerate(self.features):
+            event_keys.append(idx * self._n_codes + codes[has_key])
+            dates = feature.get_dates(events).to_numpy("datetime64[ns]")
+            event_dates.append(dates[has_key])
+            weights = feature.get_weights(events)
+            weights = np.ones(codes.shape[0]) if weights is None else weights.to_numpy()
+            event_weights.append(weights[has_key])
+
+        self._index = _asof.AsofIndex(
+            np.concatenate(event_keys or [np.zeros(0, dtype="int64")]),
+            np.concatenate(event_dates or [np.zeros(0, dtype="datetime64[ns]")]),
+            weights=np.concatenate(event_weights or [np.zeros(0)]),
+        )
+        self._positions = {
+            feature.name: idx for idx, feature in enumerate(self.features)
+        }
+
+    def sum(self, name, query_keys, query_dates, window=None):
+        """Aggregate the events of a feature before each query date.
+
+        Parameters
+        ----------
+        name : str
+            The name of the feature.
+
+        query_keys : array-like of shape (n_queries,)
+            The entity of each query.
+
+        query_dates : array-like of datetime of shape (n_queries,)
+            The observation date of each query.
+
+        window : int, default=None
+            The lookback window, in days. If None, aggregate all the history.
+
+        Returns
+        -------
+        sums : numpy.ndarray of shape (n_queries,)
+            int64 for counts, float64 for sums.
+        """
+        query_codes = self._keys.get_indexer(np.asarray(query_keys))
+        return self._sum(
+            self.features[self._positions[name]],
+            query_codes,
+            pd.Series(query_dates).reset_index(drop=True),
+            window,
+        )
+
+    def aggregate(self, single_obs):
+        """Join all the features to the observations.
+
+        Parameters
+        ----------
+        single_obs : pandas.DataFrame
+            The observations, with the entity key and the observation_date.
+
+        Returns
+        -------
+        single_obs : pandas.DataFrame
+            The observations, with one column per feature and window.
+        """
+        single_obs = single_obs.reset_index(drop=True)
+        query_codes = self._keys.get_indexer(single_obs[self.key].to_numpy())
+        query_dates = single_obs["observation_date"]
+        for feature in self.features:
+            for window, col in zip(feature.windows, feature.columns):
+                single_obs[col] = self._sum(feature, query_codes, query_dates, window)
+
+        return single_obs
+
+    def _sum(self, feature, query_codes, query_dates, window):
+        # Observations without a known entity (-1) match no events.
+        idx = self._positions[feature.name]
+        query_keys = np.where(query_codes < 0, -1, idx * self._n_codes + query_codes)
+
+        sums = self._index.sum(query_keys, query_dates, inclusive=feature.inclusive)
+        if window is not None:
+            # Events observed before the start of the window are removed.
+            start_dates = query_dates - pd.Timedelta(days=window)
+            sums = sums - self._index.sum(
+                query_keys, start_dates, inclusive=feature.inclusive
+            )
+
+        if feature.aggregation == "count":
+            sums = sums.astype("int64")
+        return sums
+
+
+def aggregate(single_obs, events, table, entity, features=None):
+    """Join the features aggregating a table per entity to the observations.
+
+    All features and windows are computed from a single sort of the events. To
+    aggregate the same events for several observation tables, build an EventIndex
+    once instead.
+
+    Parameters
+    ----------
+    single_obs : pandas.DataFrame
+        The observations, with the entity key and the observation_date.
+
+    events : pandas.DataFrame
+        The event table, with the entity key.
+
+    table : {"audits", "loans"}
+        The name of the event table.
+
+    entity : {"loan", "dealer"}
+        The entity to aggregate events per.
+
+    features : list of EventFeature, default=None
+        If None, use FEATURES.
+
+    Returns
+    -------
+    single_obs : pandas.DataFrame
+        The observations, with one column per feature and window. Counts are
+        int64, sums are float64.
+    """
+    return EventIndex(events, table, entity, features).aggregate(single_obs)
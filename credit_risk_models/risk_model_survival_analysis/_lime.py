@@ -0,0 +1,180 @@
+"""
+Batched LIME explanations of cumulative incidence predictions.
+
+LimeTabularExplainer explains each instance separately: it draws about 5000
+perturbations, scores them with the model, and fits a weighted ridge model on
+them. Without discretization, perturbations are drawn around the mean of the
+training data and don't depend on the instance, except for the instance itself
+as the first row.
+
+We draw the perturbations once and share them between all instances, so that
+the model scores them once per horizon, in a single call, instead of once per
+instance. Each instance then only adds its own row. The weighted ridge models of
+all instances are fitted at once from sufficient statistics.
+
+Each explanation has the same distribution as with LimeTabularExplainer, but
+explanations of different instances are computed from the same perturbations.
+"""
+import numpy as np
+from tqdm import tqdm
+
+
+class BatchLimeExplainer:
+    """Explain many instances at once with LIME.
+
+    This is equivalent to lime.lime_tabular.LimeTabularExplainer with
+    discretize_continuous=False, returning the coefficients of the local models.
+
+    Parameters
+    ----------
+    training_data : array-like of shape (n_samples, n_features)
+        The data used to scale and draw the perturbations.
+
+    num_samples : int, default=5000
+        The number of perturbations of each instance, including the instance.
+
+    kernel_width : float, default=None
+        The width of the exponential kernel weighting perturbations by their
+        distance to the instance. If None, use 0.75 * sqrt(n_features).
+
+    alpha : float, default=1.0
+        The regularization of the local ridge models.
+
+    batch_size : int, default=64
+        The number of local models fitted at once.
+
+    random_state : int, default=None
+        The seed of the perturbations.
+    """
+
+    def __init__(
+        self,
+        training_data,
+        num_samples=5000,
+        kernel_width=None,
+        alpha=1.0,
+        batch_size=64,
+        random_state=None,
+    ):
+        training_data = np.asarray(training_data, dtype="float64")
+        n_features = training_data.shape[1]
+
+        self.mean_ = np.nanmean(training_data, axis=0)
+        # Constant features are not scaled, like with sklearn StandardScaler.
+        scale = np.nanstd(training_data, axis=0)
+        scale[scale == 0] = 1
+        self.scale_ = scale
+
+        if kernel_width is None:
+            kernel_width = np.sqrt(n_features) * 0.75
+        self.kernel_width = kernel_width
+        self.alpha = alpha
+        self.batch_size = batch_size
+
+        # The perturbations shared by all instances, in the scaled space.
+        rng = np.random.default_rng(random_state)
+        self.noise_ = rng.standard_normal((num_samples - 1, n_features))
+
+    def explain(self, X, predict_fn, horizons, labels, verbose=False):
+        """Return the contribution of each feature to the prediction of each \
+        instance.
+
+        Parameters
+        ----------
+        X : array-like of shape (n_instances, n_features)
+            The instances to explain.
+
+        predict_fn : callable
+            Called as predict_fn(X, times), returning the cumulative incidence
+            of each label at each time, of shape (n_rows, n_labels, n_times),
+            e.g. SurvivalBoost.predict_cumulative_incidence.
+
+        horizons : array-like of shape (n_instances,)
+            The time at which each instance is explained.
+
+        labels : array-like of int of shape (n_instances,)
+            The label explained for each instance.
+
+        verbose : bool, default=False
+            Whether to display a progress bar.
+
+        Returns
+        -------
+        contributions : numpy.ndarray of shape (n_instances, n_features)
+            The coefficients of the local ridge models, in the scaled space.
+        """
+        X = np.asarray(X, dtype="float64")
+        labels = np.asarray(labels)
+        unique_horizons, horizon_indices = np.unique(
+            np.asarray(horizons), return_inverse=True
+        )
+
+        # Score the shared perturbations at all horizons in a single call.
+        perturbations = self.noise_ * self.scale_ + self.mean_
+        noise_proba = predict_fn(perturbations, unique_horizons)
+
+        # Score the instances, in one call per horizon.
+        instance_proba = np.empty((X.shape[0], noise_proba.shape[1]))
+        for idx, horizon in enumerate(unique_horizons):
+            mask = horizon_indices == idx
+            instance_proba[mask] = predict_fn(X[mask], [horizon])[:, :, 0]
+
+        Z = (X - self.mean_) / self.scale_
+        contributions = np.empty_like(Z)
+        starts = range(0, X.shape[0], self.batch_size)
+        for start in tqdm(starts, disable=not verbose):
+            batch = slice(start, start + self.batch_size)
+            y_noise = noise_proba[:, labels[batch], horizon_indices[batch]].T
+            y_instance = instance_proba[np.arange(X.shape[0])[batch], labels[batch]]
+            contributions[batch] = self._fit_local_models(
+                Z[batch], y_noise, y_instance
+            )
+
+        return contributions
+
+    def _fit_local_models(self, z, y_noise, y_instance):
+        """Fit the weighted ridge models of a batch of instances.
+
+        Parameters
+        ----------
+        z : numpy.ndarray of shape (n_batch, n_features)
+            The scaled instances.
+
+        y_noise : numpy.ndarray of shape (n_batch, n_noise)
+            The prediction of the perturbations, for the label and the horizon
+            of each instance.
+
+        y_instance : numpy.ndarray of shape (n_batch,)
+            The prediction of each instance.
+
+        Returns
+        -------
+        coefs : numpy.ndarray of shape (n_batch, n_features)
+        """
+        noise = self.noise_
+
+        # The kernel of LIME, sqrt(exp(-d ** 2 / width ** 2)). The instance itself
+        # has a weight of 1.
+        sq_distances = (
+            (noise ** 2).sum(axis=1)[None, :]
+            - 2 * z @ noise.T
+            + (z ** 2).sum(axis=1)[:, None]
+        ).clip(min=0)
+        weights = np.exp(-sq_distances / (2 * self.kernel_width ** 2))
+
+        # The weighted sums over the perturbations and the instance.
+        sum_w = weights.sum(axis=1) + 1
+        sum_x = weights @ noise + z
+        sum_y = (weights * y_noise).sum(axis=1) + y_instance
+        sum_xx = (
+            np.matmul((weights[:, :, None] * noise).transpose(0, 2, 1), noise)
+            + z[:, :, None] * z[:, None, :]
+        )
+        sum_xy = (weights * y_noise) @ noise + z * y_instance[:, None]
+
+        # Ridge with an unpenalized intercept: center on the weighted means.
+        cov_xx = sum_xx - sum_x[:, :, None] * sum_x[:, None, :] / sum_w[:, None, None]
+        cov_xy = sum_xy - sum_x * (sum_y / sum_w)[:, None]
+        cov_xx += self.alpha * np.eye(z.shape[1])
+
+        return np.linalg.solve(cov_xx, cov_xy[:, :, None])[:, :, 0]
@@ -14,6 +14,43 @@ from . import _utils
 # Terms and conditions limit to reimburse, in days.
 TC_LIMIT = 149
 
+# The columns read from the warehouse. car_loan_status and cars_carloans are
+# also read by _automative, so their specs include the columns of both modules
+# and the query results are shared within a run.
+CAR_LOAN_STATUS_SPEC = db.QuerySpec(
+    table="car_loan_status",
+    columns=(
+        "carloan_id",
+        "borrower_id",
+        "car_collateral_id",
+        "loan_state",
+        "loan_created_date",
+        "loan_maturity_date",
+        "loan_reimbursed_date",
+        "car_make",
+        "car_model",
+        "car_transmission_type",
+        "car_first_registration_date",
+    ),
+)
+CAR_LOANS_SPEC = db.QuerySpec(
+    table="cars_carloans",
+    columns=(
+        "id",
+        "borrowerid",
+        "collateralid",
+        "createdat",
+        "principal_amount",
+        "principal_currency",
+        "terminationreason",
+        "terminatedat",
+    ),
+)
+MISSING_REIMBURSEMENT_SPEC = db.QuerySpec(
+    table="missing_reimbursement",
+    columns=("carloan_id", "Car reimbursed date"),
+)
+
 
 # All risks
 class Risks(StrEnum):
@@ -153,10 +190,22 @@ def get_loans(dpd_limit=60):
 
 def _get_car_loan_status():
     missing_reimbursement = db.DBSourceRisk().fetch(
-        "SELECT * FROM missing_reimbursement"
+        MISSING_REIMBURSEMENT_SPEC.query
     )
 
-    carloan_status = db.DBSourceWH().fetch("SELECT * FROM car_loan_status")
+    # This is one of the largest tables, bulk read it.
+    cols = [
+        "carloan_id",
+        "borrower_id",
+        "car_collateral_id",
+        "loan_state",
+        "loan_created_date",
+        "loan_maturity_date",
+        "loan_reimbursed_date",
+    ]
+    carloan_status = db.DBSourceWH().fetch(
+        CAR_LOAN_STATUS_SPEC.query, method="copy"
+    )[cols]
 
     # Gather the missing reimbursment dates on car_loan_status by first merging
     # both table, then combining the reimbursment columns.
@@ -191,7 +240,7 @@ def _get_car_loans():
         "terminatedat": "terminated_at",
     }
     car_loans = db.DBSourceWH().fetch(
-        "SELECT * FROM cars_carloans", columns_renaming=names
+        CAR_LOANS_SPEC.query, columns_renaming=names, method="copy"
     )
 
     # Aggregate terminationreason with typos.
@@ -1,9 +1,21 @@
+import os
+import tempfile
+from time import time
+from pathlib import Path
 from functools import cached_property
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from dataclasses import dataclass
 import pandas as pd
 from tqdm import tqdm
-from sklearn.utils import check_random_state
-
+import pyarrow as pa
+from pyarrow import feather
+from pyarrow import parquet
+import numpy as np
+
+from . import _cache
+from . import _dtypes
+from . import _mirror
+from . import _feature_registry
 from . import _automative
 from . import _loans
 from . import _company_data
@@ -50,6 +62,23 @@ DATASET_COLS = [
 ]
 LABEL_COLS = ["event", "duration"]
 
+# The number of trajectory observations aggregated at once, to bound memory.
+TRAJECTORY_CHUNK_ROWS = 5_000_000
+
+# The DatasetMaker properties loading warehouse tables.
+SOURCE_TABLES = ["loans", "audits", "due_diligences", "cars", "companies"]
+
+# The queries read by several source tables. Their results are kept in memory
+# until all these tables have read them, see _cache.MemoryQueryCache.set_readers.
+SHARED_QUERIES = {
+    _loans.CAR_LOANS_SPEC.query: ["loans", "cars"],
+    _loans.CAR_LOAN_STATUS_SPEC.query: ["loans", "cars"],
+    _audits.DD_SPEC.query: ["due_diligences", "cars"],
+}
+
+# The DatasetMaker properties derived from the warehouse tables.
+DERIVED_TABLES = ["_audit_indices", "_dealer_audits", "_loans_train", "_loans_test"]
+
 # Remove fraudulent customers, because KYC has been improved and they do not
 # represent current customers for which we predict loan defaults.
 FRAUD_COMPANIES = [
@@ -82,6 +111,24 @@ class DatasetMaker:
     random_state: int = 42
     max_n_draw: int = 3
     verbose: bool = True
+    # When set, warehouse query results are persisted in this directory and
+    # reused by later runs, see _cache.QueryCache.
+    cache_dir: str | None = None
+    cache_ttl_hours: float | None = 24
+    # When set, the largest warehouse tables are mirrored in this directory
+    # and only their updated rows are fetched, see _mirror.WarehouseMirror.
+    mirror_dir: str | None = None
+    # The number of processes computing the aggregates, sharded by borrower.
+    # None means 1, -1 means all cores.
+    n_jobs: int | None = None
+    # When set, the dtypes of the loaded and computed tables, see
+    # _dtypes.DtypePolicy. A model must be trained and used with the same policy.
+    # None keeps the dtypes of pandas.
+    dtype_policy: _dtypes.DtypePolicy | None = None
+    # When set, training loans are observed every trajectory_period days over
+    # their life instead of at max_n_draw random dates. Use iter_dataset or
+    # write_dataset to avoid holding all the observations in memory.
+    trajectory_period: int | None = None
 
     def push_dataset(self):
         df = self.dataset
@@ -89,6 +136,7 @@ class DatasetMaker:
             df,
             table_name="p0_features",
             schema="risks",
+            method="copy",
         )
 
     def get_X_y(self):
@@ -100,9 +148,127 @@ class DatasetMaker:
     
     @cached_property
     def dataset(self):
+        dataset = self._featurize(self.loans_observations)
+        if self.verbose:
+            print(f"Memory usage:\n{self.memory_report()}")
+        return dataset
+
+    def iter_dataset(self, chunk_rows=1_000_000):
+        """Yield the dataset in chunks, to bound memory.
+
+        Chunks hold all the observations of a group of borrowers, since dealer
+        features depend on all the loans of a borrower. Rows are sorted within
+        each chunk only. Observations are drawn, aggregated and featurized chunk
+        by chunk; they are the same rows as in dataset, since each loan has its
+        own random stream in training, and all loans are observed at the same
+        date in prediction.
+
+        Parameters
+        ----------
+        chunk_rows : int, default=1_000_000
+            The approximate number of observations per chunk, before filtering.
+            A borrower with more observations makes a larger chunk. In
+            prediction, only the on-going loans are counted.
+
+        Yields
+        ------
+        chunk : pandas.DataFrame
+            A featurized and filtered chunk, with DATASET_COLS and the windowed
+            features.
+        """
+        if self.is_training:
+            iter_observations = self._iter_observations_train
+        else:
+            iter_observations = self._iter_observations_test
+
+        for loans_obs in iter_observations(chunk_rows):
+            yield self._featurize(loans_obs)
+
+    def write_dataset(self, path, chunk_rows=1_000_000):
+        """Write the dataset as a directory of Parquet files, one per chunk.
+
+        See iter_dataset. The chunks are written with the same schema, see
+        _dtypes.get_arrow_schema, so the directory can be read back with
+        pandas.read_parquet.
+
+        Parameters
+        ----------
+        path : str
+            The directory to write to. Existing chunk files are replaced.
+
+        chunk_rows : int, default=1_000_000
+            The approximate number of observations per chunk.
+
+        Returns
+        -------
+        paths : list of pathlib.Path
+            The chunk files.
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        for old_path in path.glob("part-*.parquet"):
+            old_path.unlink()
+
+        paths, schema = [], None
+        for idx, chunk in enumerate(self.iter_dataset(chunk_rows=chunk_rows)):
+            # The chunks are cast to the schema of the first one, otherwise their
+            # types would depend on their values, e.g. a column missing in a
+            # chunk, and the files couldn't be read back together.
+            if schema is None:
+                schema = _dtypes.get_arrow_schema(chunk)
+            table = pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+            chunk_path = path / f"part-{idx:05d}.parquet"
+            parquet.write_table(table, chunk_path)
+            paths.append(chunk_path)
+
+        return paths
+
+    def sample_dataset(self, n_rows):
+        """Return the dataset of a random sample of borrowers.
+
+        Like the chunks of iter_dataset, the sample holds all the observations of
+        its borrowers. Borrowers are drawn in a random order, only depending on
+        their id and random_state, until their observations reach n_rows. The
+        sample thus doesn't depend on how the dataset is chunked.
+
+        Parameters
+        ----------
+        n_rows : int
+            The approximate number of observations of the sample, before
+            filtering. In prediction, only the on-going loans are counted.
+
+        Returns
+        -------
+        sample : pandas.DataFrame
+            The featurized and filtered observations of the sampled borrowers.
+        """
+        if self.is_training:
+            loans = self._loans_train
+            n_obs = self._get_n_observations(loans)
+        else:
+            loans = self._loans_test
+            n_obs = (loans["risks"] == _loans.Risks.on_going).astype("int64")
+
+        n_obs = n_obs.groupby(loans["borrower_id"], dropna=False).sum()
+        order = np.argsort(
+            _get_loan_uniforms(n_obs.index, n_draw=0, random_state=self.random_state)
+        )
+        n_obs = n_obs.iloc[order]
+        # Draw borrowers until the previous ones have n_rows observations.
+        borrower_ids = n_obs.index[(n_obs.cumsum() - n_obs) < n_rows]
+        loans = loans.loc[loans["borrower_id"].isin(borrower_ids)]
+
+        if self.is_training:
+            loans_obs = self._aggregate_observations(self._draw_observations(loans))
+        else:
+            loans_obs = self._observe_test(loans)
+        return self._featurize(loans_obs)
 
+    def _featurize(self, loans_observations):
+        """Join cars and companies to the observations, and filter them.
+        """
         loans_observations = (
-            self.loans_observations.merge(
+            loans_observations.merge(
                 self.cars,
                 # Using additional ids in keys to avoid having suffixes _x, _y
                 # in the final merged dataframe.
@@ -138,31 +304,139 @@ class DatasetMaker:
         mask = ~loans_observations["company_registration_number"].isin(FRAUD_COMPANIES)
         loans_observations = loans_observations.loc[mask]
                 
-        return loans_observations[DATASET_COLS].reset_index(drop=True)
+        cols = _get_dataset_cols()
+        return self._compact(loans_observations[cols].reset_index(drop=True))
+
+    def prefetch(self, tables=None, n_jobs=None):
+        """Load all the source tables concurrently.
+
+        Each table is loaded in its own thread, with its own pooled connection,
+        so that the loading time is set by the slowest table instead of the sum
+        of all tables. Tables already loaded are skipped.
+
+        Parameters
+        ----------
+        tables : list of str, default=None
+            The tables to load, among SOURCE_TABLES. If None, load all of them.
+
+        n_jobs : int, default=None
+            The number of threads. If None, use one thread per table.
+
+        Returns
+        -------
+        self : DatasetMaker
+        """
+        tables = SOURCE_TABLES if tables is None else tables
+        unknown = set(tables).difference(SOURCE_TABLES)
+        if unknown:
+            raise ValueError(f"tables must be among {SOURCE_TABLES}, got {unknown}.")
+
+        names = [name for name in tables if name not in self.__dict__]
+        if not names:
+            return self
+
+        # Shared queries are kept in memory until all the tables loaded here
+        # have read them.
+        for query, readers in SHARED_QUERIES.items():
+            self.query_cache.set_readers(query, len(set(readers).intersection(names)))
+
+        start = time()
+        with ThreadPoolExecutor(max_workers=n_jobs or len(names)) as executor:
+            # Accessing the cached properties populates them.
+            futures = {name: executor.submit(getattr, self, name) for name in names}
+            for future in futures.values():
+                # Re-raise errors from the threads.
+                future.result()
+
+        if self.verbose:
+            print(f"Prefetched {names} in {time() - start:.1f}s")
+            self.print_cache_stats()
+
+        return self
 
     @cached_property
     def loans(self):
-        return _loans.get_loans()
+        with db.use_query_cache(self.query_cache):
+            return self._compact(_loans.get_loans())
 
     @cached_property
     def audits(self):
-        return _audits.get_audits()
+        with db.use_query_cache(self.query_cache):
+            return self._compact(_audits.get_audits())
 
     @cached_property
     def due_diligences(self):
-        return _audits.get_dd()
+        with db.use_query_cache(self.query_cache):
+            return self._compact(_audits.get_dd())
 
     @cached_property
     def cars(self):
-        return _automative.get_automative()
+        with db.use_query_cache(self.query_cache):
+            return self._compact(_automative.get_automative())
 
     @cached_property
     def companies(self):
-        return _company_data.get_company_data()
+        with db.use_query_cache(self.query_cache):
+            return self._compact(_company_data.get_company_data())
+
+    @cached_property
+    def query_cache(self):
+        # Tables read by several loaders are only fetched once per DatasetMaker.
+        backend = None
+        if self.cache_dir is not None:
+            backend = _cache.QueryCache(
+                cache_dir=self.cache_dir, ttl_hours=self.cache_ttl_hours
+            )
+        if self.mirror_dir is not None:
+            backend = _mirror.WarehouseMirror(
+                mirror_dir=self.mirror_dir, backend=backend
+            )
+        query_cache = _cache.MemoryQueryCache(backend=backend)
+        # Shared queries are kept in memory until all their tables are loaded,
+        # also when the tables are loaded lazily instead of by prefetch.
+        for query, readers in SHARED_QUERIES.items():
+            query_cache.set_readers(query, len(readers))
+        return query_cache
+
+    def memory_report(self):
+        """Return the memory used by the tables loaded or computed so far.
+        """
+        names = SOURCE_TABLES + DERIVED_TABLES + [
+            "_loans_observations_train", "_loans_observations_test", "dataset"
+        ]
+        tables = {
+            name: self.__dict__[name] for name in names
+            if isinstance(self.__dict__.get(name), pd.DataFrame)
+        }
+        return _dtypes.memory_report(tables)
+
+    def _compact(self, df):
+        if self.dtype_policy is None:
+            return df
+        return self.dtype_policy.apply(df)
+
+    def print_cache_stats(self):
+        """Print the warehouse transfers saved by sharing query results.
+        """
+        stats = self.query_cache.get_stats()
+        print(
+            f"Query cache: {stats['n_hits']} hits, {stats['n_misses']} misses, "
+            f"saved {stats['bytes_saved'] / 1024 ** 2:.1f}MB "
+            f"and {stats['seconds_saved']:.1f}s of fetching"
+        )
+
+    def invalidate_cache(self):
+        """Remove the tables persisted on disk and in memory, including the
+        mirrored tables, which are then fully synced again.
+        """
+        self.query_cache.invalidate()
+        # The shared queries are registered again with a new cache.
+        for name in ["query_cache"] + SOURCE_TABLES + DERIVED_TABLES:
+            self.__dict__.pop(name, None)
 
     @property
     def _features(self):
-        return list(set(DATASET_COLS).difference(LABEL_COLS))
+        return list(set(_get_dataset_cols()).difference(LABEL_COLS))
 
     @cached_property
     def loans_observations(self):
@@ -174,15 +448,62 @@ class DatasetMaker:
         
     @cached_property
     def _loans_observations_train(self):
+        if self.trajectory_period is not None:
+            # Trajectories are aggregated chunk by chunk, which bounds the
+            # memory of the aggregation, but all the observations are returned.
+            return (
+                pd.concat(
+                    self._iter_observations_train(TRAJECTORY_CHUNK_ROWS),
+                    ignore_index=True,
+                )
+                .sort_values(["carloan_id", "observation_date"])
+                .reset_index(drop=True)
+            )
 
+        loans_obs = self._draw_observations(self._loans_train)
+        return self._aggregate_observations(loans_obs)
+
+    def _iter_observations_train(self, chunk_rows):
+        """Yield the aggregated observations of _loans_train, by chunks of \
+        borrowers.
+        """
+        loans = self._loans_train
+        chunks = _get_borrower_chunks(
+            loans["borrower_id"],
+            n_rows=self._get_n_observations(loans),
+            chunk_rows=chunk_rows,
+        )
+        n_chunks = chunks.max() + 1 if chunks.shape[0] > 0 else 0
+
+        iter_ = range(n_chunks)
+        if self.verbose:
+            iter_ = tqdm(iter_)
+
+        for chunk in iter_:
+            loans_obs = self._draw_observations(loans.loc[chunks == chunk])
+            yield self._aggregate_observations(loans_obs)
+
+    def _aggregate_observations(self, loans_obs):
+        """Compute the aggregates of observations.
+        """
+        return (
+            self._compact(self._compute_aggregate(loans_obs))
+            .sort_values(["carloan_id", "observation_date"])
+            .reset_index(drop=True)
+        )
+
+    @cached_property
+    def _loans_train(self):
+        """The loans with the number of observations to draw for each of them.
+        """
         loans = self.loans.copy()
-        rng = check_random_state(self.random_state)
 
         # Set loan duration relative to today for on-going loans. This is only use to
         # compute the number of samples to be made.
-        loans.loc[loans["is_ongoing"], "loan_duration"] = (
-            pd.Timestamp.now() - loans.loc[loans["is_ongoing"]]["loan_created_date"]
-        ).dt.days
+        loans["loan_duration"] = loans["loan_duration"].where(
+            ~loans["is_ongoing"],
+            (pd.Timestamp.now() - loans["loan_created_date"]).dt.days,
+        )
 
         # Loan duration is capped to 149 days.
         loans["loan_duration_clipped"] = loans["loan_duration"].clip(
@@ -192,8 +513,61 @@ class DatasetMaker:
         loans["n_observation_draw"] = (
             loans["loan_duration_clipped"] // self.draw_sample_period
         )
+        return loans
+
+    def _get_n_observations(self, loans):
+        """The number of observations of each loan of _loans_train.
+        """
+        if self.trajectory_period is None:
+            return loans["n_observation_draw"].clip(upper=self.max_n_draw) + 1
+
+        # Observations at days 0, k, 2k, ... before the clipped loan duration, and
+        # at least at the creation date.
+        n_steps = (loans["loan_duration_clipped"] - 1) // self.trajectory_period + 1
+        return n_steps.clip(lower=1).fillna(1).astype("int64")
+
+    def _draw_observations(self, loans):
+        """Draw observation dates for loans of _loans_train.
+        """
+        if self.trajectory_period is not None:
+            loans_obs = self._get_trajectories(loans)
+        else:
+            loans_obs = self._sample_observations(loans)
+
+        loans_obs["loan_age_days"] = (
+            loans_obs["observation_date"] - loans_obs["loan_created_date"]
+        ).dt.days
+
+        loans_obs["target_duration"] = (
+            loans_obs["loan_duration"] - loans_obs["loan_age_days"]
+        )
+        return loans_obs
+
+    def _get_trajectories(self, loans):
+        """Observe each loan every trajectory_period days.
+        """
+        n_observations = self._get_n_observations(loans).to_numpy()
+        loans_obs = loans.iloc[
+            np.repeat(np.arange(loans.shape[0]), n_observations)
+        ].reset_index(drop=True)
+
+        # The step of each observation within its loan: 0, 1, ..., n - 1.
+        starts = np.repeat(np.cumsum(n_observations) - n_observations, n_observations)
+        steps = np.arange(loans_obs.shape[0]) - starts
+
+        loans_obs["observation_date"] = loans_obs["loan_created_date"] + (
+            pd.to_timedelta(steps * self.trajectory_period, unit="D")
+        )
+        return loans_obs
+
+    def _sample_observations(self, loans):
+        """Observe each loan at its creation date, and at most max_n_draw random \
+        dates.
+        """
         max_n_draw = min(loans["n_observation_draw"].max(), self.max_n_draw)
 
+        # Draw all observation dates first, then compute the aggregates in a single
+        # pass over the long observation table.
         iter_ = range(int(max_n_draw) + 1)
         if self.verbose:
             iter_ = tqdm(iter_)
@@ -208,40 +582,63 @@ class DatasetMaker:
                 single_obs = loans.query("n_observation_draw >= @n_draw").reset_index(
                     drop=True
                 )
-                sampled_days = rng.randint(
-                    low=0, high=single_obs["loan_duration_clipped"], dtype="int32"
+                # Each loan has its own random stream, so that its observation
+                # dates don't depend on the other loans.
+                uniforms = _get_loan_uniforms(
+                    single_obs["carloan_id"], n_draw, self.random_state
                 )
+                sampled_days = (
+                    uniforms * single_obs["loan_duration_clipped"].to_numpy()
+                ).astype("int32")
                 single_obs["sampled_days"] = pd.to_timedelta(sampled_days, unit="D")
                 single_obs["observation_date"] = (
                     single_obs["loan_created_date"] + single_obs["sampled_days"]
                 )
+            loans_obs.append(single_obs)
 
-            single_obs["loan_age_days"] = (
-                single_obs["observation_date"] - single_obs["loan_created_date"]
-            ).dt.days
+        return pd.concat(loans_obs, axis=0, ignore_index=True)
 
-            single_obs["target_duration"] = (
-                single_obs["loan_duration"] - single_obs["loan_age_days"]
-            )
+    @cached_property
+    def _loans_observations_test(self):
+        return self._observe_test(self._loans_test)
+
+    def _iter_observations_test(self, chunk_rows):
+        """Yield the aggregated observations of the on-going loans, by chunks of \
+        borrowers.
+        """
+        loans = self._loans_test
+        chunks = _get_borrower_chunks(
+            loans["borrower_id"],
+            n_rows=(loans["risks"] == _loans.Risks.on_going).astype("int64"),
+            chunk_rows=chunk_rows,
+        )
+        n_chunks = chunks.max() + 1 if chunks.shape[0] > 0 else 0
 
-            loans_obs.append(self._compute_aggregate(single_obs))
+        iter_ = range(n_chunks)
+        if self.verbose:
+            iter_ = tqdm(iter_)
 
-        loans_obs = (
-            pd.concat(loans_obs, axis=0)
-            .sort_values(["carloan_id", "observation_date"])
-            .reset_index(drop=True)
-        )
-        return loans_obs
+        for chunk in iter_:
+            yield self._observe_test(loans.loc[chunks == chunk])
 
     @cached_property
-    def _loans_observations_test(self):
-        
+    def _loans_test(self):
+        """All the loans, observed now.
+        """
         loans = self.loans.copy()
+        # All chunks are observed at the same date.
+        loans["observation_date"] = pd.Timestamp.now()
+        return loans
+
+    def _observe_test(self, loans):
+        """Compute the features of the on-going loans among loans of _loans_test.
 
+        loans must hold all the loans of their borrowers.
+        """
         # We can't remove closed loans at this stage because we need them to derive
         # features for on-going loans.
-        loans["observation_date"] = pd.Timestamp.now()
         loans_obs = self._compute_aggregate(loans)
+        loans_obs = self._compact(loans_obs)
 
         # Now that we build our desired features, we only keep on-going loans for
         # testing.
@@ -254,7 +651,7 @@ class DatasetMaker:
 
         # For consistency, we shouldn't train the model using these.
         loans_obs["loan_duration"] = (
-            pd.Timestamp.now() - loans_obs["loan_created_date"]
+            loans_obs["observation_date"] - loans_obs["loan_created_date"]
         ).dt.days
         loans_obs["target_duration"] = (
             loans_obs["loan_duration"] - loans_obs["loan_age_days"]
@@ -270,237 +667,255 @@ class DatasetMaker:
 
     def _compute_aggregate(self, single_obs):
 
-        single_obs = _agg_join_audit_loan(single_obs, self.audits.copy())
-        single_obs = _agg_join_audit_dealer(single_obs, self.audits.copy())
-        single_obs = _agg_join_labels_dealer(single_obs)
+        n_jobs = _get_n_jobs(self.n_jobs)
+        if n_jobs > 1:
+            return self._compute_aggregate_parallel(single_obs, n_jobs)
+
+        return _aggregate(single_obs, self._audit_indices)
+
+    def _compute_aggregate_parallel(self, single_obs, n_jobs):
+        """Compute the aggregates of borrower shards on a process pool.
+
+        All aggregates only depend on the loans and audits of the same borrower.
+        Shards are exchanged with the workers as uncompressed Arrow files, which
+        are memory-mapped instead of pickled through the pool, see _read_arrow.
+        """
+        single_obs = single_obs.reset_index(drop=True)
+        # When aggregating a chunk of borrowers, only their audits are needed.
+        dealer_audits = self._dealer_audits
+        dealer_audits = dealer_audits.loc[
+            dealer_audits["borrower_id"].isin(single_obs["borrower_id"].unique())
+        ]
+
+        # More shards than workers, to balance borrowers of different sizes.
+        n_shards = n_jobs * 4
+        obs_shards = _get_shards(single_obs["borrower_id"], n_shards)
+        audit_shards = _get_shards(dealer_audits["borrower_id"], n_shards)
+
+        with (
+            tempfile.TemporaryDirectory() as tmp_dir,
+            ProcessPoolExecutor(max_workers=n_jobs) as executor,
+        ):
+            futures = []
+            for shard in range(n_shards):
+                obs_path, audits_path, result_path = [
+                    Path(tmp_dir) / f"{name}_{shard}.arrow"
+                    for name in ["obs", "audits", "result"]
+                ]
+                _write_arrow(
+                    single_obs.loc[obs_shards == shard].assign(
+                        _row=lambda df: df.index
+                    ),
+                    obs_path,
+                )
+                _write_arrow(dealer_audits.loc[audit_shards == shard], audits_path)
+                futures.append(
+                    executor.submit(
+                        _compute_aggregate_shard, obs_path, audits_path, result_path
+                    )
+                )
 
-        return single_obs
+            # Re-raise errors from the workers, and put rows back in order.
+            aggregates = pd.concat(
+                [_read_arrow(future.result()) for future in futures],
+                ignore_index=True,
+            )
+            aggregates = aggregates.set_index("_row").sort_index()
 
+        if self.verbose:
+            print(f"Computed aggregates of {n_shards} shards on {n_jobs} processes.")
 
-def _agg_join_audit_loan(single_obs, audits):
-    """Aggregate audit features at the loan level.
-    """
-    cols = ["carloan_id", "observation_date"]
-    audits = audits.merge(single_obs[cols], on="carloan_id")
-
-    # Only keep audits when we can observe their "scheduled from" date
-    # and that are not cancelled.
-    obs_date = audits["observation_date"]
-    mask = (
-        (audits["audit_scheduled_for_from"] <= obs_date)
-        & (~audits["audit_cancelled"])
+        return single_obs.join(aggregates)
+
+    @cached_property
+    def _audit_indices(self):
+        """The audits sorted per loan and per dealer, built once and shared by all
+        the observations, see _feature_registry.EventIndex.
+        """
+        return _get_audit_indices(self.audits, self._dealer_audits)
+
+    @cached_property
+    def _dealer_audits(self):
+        return _get_dealer_audits(self.audits, self.loans)
+
+
+def _get_dataset_cols():
+    # The features over finite windows are only known once registered.
+    return DATASET_COLS + _feature_registry.get_window_columns()
+
+
+def _aggregate(single_obs, audit_indices):
+    single_obs = _add_audit_ratios(
+        audit_indices["loan"].aggregate(single_obs), level="loan"
     )
-    n_past_audits = (
-        audits.loc[mask].groupby("carloan_id").size().rename("loan_n_past_audits")
+    single_obs = _add_audit_ratios(
+        audit_indices["dealer"].aggregate(single_obs), level="dealer"
     )
+    return _agg_join_labels_dealer(single_obs)
+
+
+def _get_dealer_audits(audits, loans):
+    """Return the audits of the loans we know the dealer (borrower_id) of."""
+    loans = loans[["carloan_id", "borrower_id"]].drop_duplicates(subset="carloan_id")
+    return audits.merge(loans, on="carloan_id")
 
-    audits["is_audit_overdue"] = _get_audit_overdue_mask(audits, obs_date)
-    loan_n_audit_overdue = (
-        audits.groupby("carloan_id")[["is_audit_overdue"]]
-        .sum()
-        .rename(
-            columns={
-                "is_audit_overdue": "loan_n_audit_overdue",
-            }
-        )
-    )
 
-    mask = audits["audit_submission_date"] < audits["observation_date"]
-    rename_cols = {
-        "audit_approved": "loan_n_audit_approved",
-        "audit_rejected": "loan_n_audit_rejected",
+def _get_audit_indices(audits, dealer_audits):
+    return {
+        "loan": _feature_registry.EventIndex(audits, table="audits", entity="loan"),
+        "dealer": _feature_registry.EventIndex(
+            dealer_audits, table="audits", entity="dealer"
+        ),
     }
-    totals = (
-        audits.loc[mask]
-        .groupby("carloan_id")[list(rename_cols)]
-        .sum()
-        .rename(columns=rename_cols)
-    )
 
-    # concat() uses the carloan_id index to align the different dataframes.
-    group = pd.concat(
-        [n_past_audits, loan_n_audit_overdue, totals], axis=1
-    ).reset_index()
 
-    group["loan_ratio_audit_overdue"] = (
-        group["loan_n_audit_overdue"] / group["loan_n_past_audits"]
-    )
-    group["loan_ratio_audit_approved"] = (
-        group["loan_n_audit_approved"] / group["loan_n_past_audits"]
-    )
-    group["loan_ratio_audit_rejected"] = (
-        group["loan_n_audit_rejected"] / group["loan_n_past_audits"]
-    )
+def _compute_aggregate_shard(obs_path, audits_path, result_path):
+    """Compute the aggregates of a borrower shard, in a worker process.
 
-    cols = [
-        "carloan_id",
-        "loan_n_past_audits",
-        "loan_n_audit_overdue",
-        "loan_n_audit_approved",
-        "loan_n_audit_rejected",
-        "loan_ratio_audit_overdue",
-        "loan_ratio_audit_approved",
-        "loan_ratio_audit_rejected",
+    Only the aggregate columns are written back, with the row of each observation.
+    """
+    single_obs = _read_arrow(obs_path)
+    audits = _read_arrow(audits_path)
+
+    # The audits of a shard are those of its borrowers.
+    aggregates = _aggregate(single_obs, _get_audit_indices(audits, audits))
+    cols = ["_row"] + [
+        col for col in aggregates.columns if col not in single_obs.columns
     ]
-    single_obs = single_obs.merge(group[cols], on="carloan_id", how="left")
-    single_obs[cols] = single_obs[cols].fillna(0)
+    _write_arrow(aggregates[cols], result_path)
+    return result_path
 
-    return single_obs
 
+def _get_loan_uniforms(carloan_ids, n_draw, random_state):
+    """Return a uniform number in [0, 1) per loan, only depending on its \
+    carloan_id, n_draw and random_state.
 
-def _agg_join_audit_dealer(single_obs, audits):
-    """Aggregate audit features at the dealer level.
+    Adding, removing or reordering loans, or sharding them, doesn't change the
+    numbers of the other loans.
     """
-    cols = ["carloan_id", "borrower_id"]
-    audits = audits.merge(single_obs[cols], on="carloan_id")
-
-    group = []
-    for carloan_id, borrower_id, obs_date in single_obs[
-        ["carloan_id", "borrower_id", "observation_date"]
-    ].values:
-        borrower_audits = audits.query("borrower_id == @borrower_id").reset_index(
-            drop=True
-        )
+    # A salt per (random_state, n_draw), mixed with the hash of each carloan_id by
+    # the splitmix64 finalizer.
+    seed_seq = np.random.SeedSequence(random_state, spawn_key=(n_draw,))
+    salt = seed_seq.generate_state(1, dtype=np.uint64)[0]
+    x = pd.util.hash_pandas_object(pd.Series(carloan_ids), index=False).to_numpy()
+    x = x ^ salt
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    x = x ^ (x >> np.uint64(31))
+
+    # The 53 highest bits fill the mantissa of a float64.
+    return (x >> np.uint64(11)) * 2.0 ** -53
+
+
+def _get_borrower_chunks(borrower_ids, n_rows, chunk_rows):
+    """Assign each loan to a chunk of about chunk_rows observations, keeping the \
+    loans of a borrower in the same chunk.
+    """
+    rows_per_borrower = n_rows.groupby(borrower_ids, dropna=False).sum()
+    borrower_chunks = (rows_per_borrower.cumsum() - 1) // chunk_rows
+    # Chunks are numbered from 0 without gaps.
+    borrower_chunks = pd.Series(
+        pd.factorize(borrower_chunks.to_numpy())[0], index=rows_per_borrower.index
+    )
+    return borrower_ids.map(borrower_chunks).to_numpy()
 
-        mask_past_audits = (
-            (borrower_audits["audit_scheduled_for_from"] < obs_date)
-            & (~borrower_audits["audit_cancelled"])
-        )
-        n_past_audits = mask_past_audits.sum()
 
-        n_audit_overdue = _get_audit_overdue_mask(borrower_audits, obs_date).sum()
+def _get_shards(borrower_ids, n_shards):
+    # Stable across processes and runs, unlike the builtin hash.
+    hashes = pd.util.hash_pandas_object(borrower_ids, index=False).to_numpy()
+    return hashes % n_shards
 
-        mask = (
-            mask_past_audits
-            & (borrower_audits["audit_submission_date"] < obs_date)
-        )
-        n_audit_approved = (borrower_audits["audit_approved"] & mask).sum()
-        n_audit_rejected = (borrower_audits["audit_rejected"] & mask).sum()
-
-        group.append(
-            dict(
-                carloan_id=carloan_id,
-                dealer_n_past_audits=n_past_audits,
-                dealer_n_audit_overdue=n_audit_overdue,
-                dealer_n_audit_approved=n_audit_approved,
-                dealer_n_audit_rejected=n_audit_rejected,
-            )
-        )
 
-    group = pd.DataFrame(group)
-    group["dealer_ratio_audit_overdue"] = (
-        group["dealer_n_audit_overdue"] / group["dealer_n_past_audits"]
-    )
-    group["dealer_ratio_audit_approved"] = (
-        group["dealer_n_audit_approved"] / group["dealer_n_past_audits"]
-    )
-    group["dealer_ratio_audit_rejected"] = (
-        group["dealer_n_audit_rejected"] / group["dealer_n_past_audits"]
-    )
+def _get_n_jobs(n_jobs):
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(os.cpu_count() + 1 + n_jobs, 1)
+    return n_jobs
 
-    cols = [
-        "carloan_id",
-        "dealer_n_past_audits",
-        "dealer_n_audit_overdue",
-        "dealer_n_audit_approved",
-        "dealer_n_audit_rejected",
-        "dealer_ratio_audit_overdue",
-        "dealer_ratio_audit_approved",
-        "dealer_ratio_audit_rejected",  
-    ]
-    single_obs = single_obs.merge(group[cols], on="carloan_id", how="left")
-    single_obs[cols] = single_obs[cols].fillna(0)
 
-    return single_obs
+def _write_arrow(df, path):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    feather.write_feather(table, path, compression="uncompressed")
+
+
+def _read_arrow(path):
+    # Memory-mapped, and converted column by column: the numeric and datetime
+    # columns without missing values are then read-only views of the file,
+    # without copies.
+    return feather.read_table(path, memory_map=True).to_pandas(split_blocks=True)
 
 
 def _agg_join_labels_dealer(single_obs):
     """Aggregate labels at the dealer level.
+
+    Like the dealer audits, each loan of the dealer contributes to a count once
+    the date defining it (creation, reimbursment or end) is strictly before the
+    observation date.
     """
-    # TODO: this function takes 10s to run, improve or find the bottleneck.
-    group = []
-    for carloan_id, borrower_id, obs_date in single_obs[
-        ["carloan_id", "borrower_id", "observation_date"]
-    ].values:
-        borrower_loans = single_obs.query("borrower_id == @borrower_id")
-
-        n_cars_financed = (borrower_loans["loan_created_date"] < obs_date).sum()
-
-        # Null dates are not taken into account in this average
-        mask = borrower_loans["loan_reimbursed_date"] < obs_date
-        avg_reimbursment_days = (
-            borrower_loans.loc[mask]["loan_reimbursed_date"]
-            - borrower_loans.loc[mask]["loan_created_date"]
-        ).dt.days.mean()
-
-        mask = borrower_loans["loan_end_date"] < obs_date
-        n_cars_sold_np = (
-            (borrower_loans["risks"] == _loans.Risks.car_sold_np) & mask
-        ).sum()
-
-        n_maturity_reached = (
-            (borrower_loans["risks"] == _loans.Risks.maturity_reached) & mask
-        ).sum()
-
-        n_cars_reimbursed = (
-            (borrower_loans["risks"] == _loans.Risks.reimbursed) & mask
-        ).sum()
-
-        # A loan is on-going when we haven't observed the end date yet.
-        n_loan_ongoing = (
-            (borrower_loans["loan_created_date"] < obs_date)
-            & (~(borrower_loans["loan_end_date"] < obs_date))
-        ).sum()
-
-        group.append(
-            dict(
-                carloan_id=carloan_id,
-                dealer_n_cars_financed=n_cars_financed,
-                dealer_avg_reimbursment_days=avg_reimbursment_days,
-                dealer_n_cars_reimbursed=n_cars_reimbursed,
-                dealer_n_maturity_reached=n_maturity_reached,
-                dealer_n_cars_sold_np=n_cars_sold_np,
-                dealer_n_loan_ongoing=n_loan_ongoing,
-            )
-        )
+    # single_obs can hold several observation dates for the same loan, but each
+    # loan must only be counted once.
+    loans = single_obs.drop_duplicates(subset="carloan_id")
+    single_obs = _feature_registry.aggregate(
+        single_obs, loans, table="loans", entity="dealer"
+    )
+    return _add_labels_ratios(single_obs)
+
+
+def _add_audit_ratios(single_obs, level):
+    """Divide the audit counts of a level ("loan" or "dealer") by the number of \
+    past audits.
+    """
+    # Ratios are 0 when there are no past audits, except for dealers with audits
+    # counted before their first past audit, whose ratios are inf.
+    n_past_audits = single_obs[f"{level}_n_past_audits"]
+    if level == "loan":
+        n_past_audits = n_past_audits.where(n_past_audits > 0)
+    for name in ["overdue", "approved", "rejected"]:
+        single_obs[f"{level}_ratio_audit_{name}"] = (
+            single_obs[f"{level}_n_audit_{name}"] / n_past_audits
+        ).fillna(0)
+
+    return single_obs
+
+
+def _add_labels_ratios(single_obs):
+    """Derive the dealer label features from the intermediate counts of \
+    _feature_registry.FEATURES.
+    """
+    # The intermediate counts are replaced in place, to keep the column order.
+    single_obs["dealer_sum_reimbursment_days"] /= (
+        single_obs["dealer_n_reimbursment_days"]
+    )
+
+    # We subtract the financed loans whose end date has been observed.
+    single_obs["dealer_n_loan_closed"] = (
+        single_obs["dealer_n_cars_financed"] - single_obs["dealer_n_loan_closed"]
+    )
+    single_obs = single_obs.drop(columns="dealer_n_reimbursment_days").rename(
+        columns={
+            "dealer_sum_reimbursment_days": "dealer_avg_reimbursment_days",
+            "dealer_n_loan_closed": "dealer_n_loan_ongoing",
+        }
+    )
 
-    group = pd.DataFrame(group)
-    group["dealer_ratio_reimbursed"] = (
-        group["dealer_n_cars_reimbursed"] / group["dealer_n_cars_financed"]
+    single_obs["dealer_ratio_reimbursed"] = (
+        single_obs["dealer_n_cars_reimbursed"] / single_obs["dealer_n_cars_financed"]
     )
-    group["dealer_ratio_maturity_reached"] = (
-        group["dealer_n_maturity_reached"] / group["dealer_n_cars_financed"]
+    single_obs["dealer_ratio_maturity_reached"] = (
+        single_obs["dealer_n_maturity_reached"] / single_obs["dealer_n_cars_financed"]
     )
-    group["dealer_ratio_cars_sold_np"] = (
-        group["dealer_n_cars_sold_np"] / group["dealer_n_cars_financed"]
+    single_obs["dealer_ratio_cars_sold_np"] = (
+        single_obs["dealer_n_cars_sold_np"] / single_obs["dealer_n_cars_financed"]
     )
 
     cols = [
-        "carloan_id",
-        "dealer_n_cars_financed",
         "dealer_avg_reimbursment_days",
-        "dealer_n_cars_reimbursed",
-        "dealer_n_maturity_reached",
-        "dealer_n_cars_sold_np",
-        "dealer_n_loan_ongoing",
         "dealer_ratio_reimbursed", 
         "dealer_ratio_maturity_reached",
         "dealer_ratio_cars_sold_np",
     ]
-    single_obs = single_obs.merge(group[cols], on="carloan_id", how="left")
     single_obs[cols] = single_obs[cols].fillna(0)
 
     return single_obs
 
-
-def _get_audit_overdue_mask(audits, obs_date):
-    """An audit is overdue when we can observe its due date, it hasn't been submitted \
-    before the due date and is not cancelled.
-    """
-    return (
-        (audits["audit_due_date"] < obs_date)
-        &  (
-                ~(audits["audit_submission_date"] < audits["audit_due_date"])
-                & (~audits["audit_cancelled"])
-        )       
-    )
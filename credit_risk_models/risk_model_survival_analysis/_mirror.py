@@ -0,0 +1,249 @@
+"""
+Incremental local mirror of warehouse tables.
+
+Instead of reloading the full history of a table every day, the mirror keeps
+a Parquet copy of it, and only fetches the rows updated since the last sync
+(the watermark). These rows are merged into the copy by primary key.
+
+A full resync is done when the mirror is empty, when the query changed, when
+the table has no update timestamp, when the delta query fails, or every
+full_resync_days to catch deleted rows. Each table is synced at most once per
+WarehouseMirror, i.e. once per build of DatasetMaker: later loads read the
+Parquet copy.
+
+Both the full and the delta syncs fetch with COPY, so that merged rows have the
+same dtypes.
+"""
+import json
+import dataclasses
+from time import time
+from pathlib import Path
+from dataclasses import dataclass
+
+import pandas as pd
+import psycopg2
+
+from . import db
+from . import _logs
+from . import _cache
+from . import _audits
+from . import _loans
+
+
+@dataclass(frozen=True)
+class MirroredTable:
+    """How to incrementally sync a table.
+
+    Parameters
+    ----------
+    spec : db.QuerySpec
+        The query read by the loaders.
+
+    primary_key : str
+        The column identifying rows, used to merge updates.
+
+    watermark_column : str or None
+        A timestamp column updated with each row. If None, the table is
+        fully refreshed at every sync.
+    """
+
+    spec: db.QuerySpec
+    primary_key: str
+    watermark_column: str | None = "updatedat"
+
+    @property
+    def spec_to_sync(self):
+        # The primary key and the watermark must be fetched, even when the
+        # loaders don't use them.
+        extra_columns = tuple(
+            col for col in (self.primary_key, self.watermark_column)
+            if col is not None and col not in self.spec.columns
+        )
+        return dataclasses.replace(self.spec, columns=self.spec.columns + extra_columns)
+
+
+# The company tables read by _company_data are not mirrored: they have one row
+# per borrower, so fetching them fully is cheap, and they are cached by the
+# backend. Neither is the car_loan_status view: it has no update timestamp, so
+# mirroring it would fully fetch and rewrite it at every sync, for nothing.
+MIRRORED_TABLES = [
+    MirroredTable(_audits.AUDITS_SPEC, primary_key="id"),
+    MirroredTable(_audits.DD_SPEC, primary_key="id"),
+    MirroredTable(_loans.CAR_LOANS_SPEC, primary_key="id"),
+]
+
+
+@dataclass
+class WarehouseMirror(_logs.LogsMixin):
+    """Serve mirrored tables from a local copy synced incrementally.
+
+    This has the same interface as _cache.QueryCache, so it can be used as
+    the backend of _cache.MemoryQueryCache. Queries of tables that are not
+    mirrored are delegated to the backend.
+
+    Parameters
+    ----------
+    mirror_dir : str, default=".warehouse_mirror"
+        The directory of the Parquet copies.
+
+    tables : list of MirroredTable, default=None
+        The mirrored tables. If None, use MIRRORED_TABLES.
+
+    full_resync_days : float, default=7
+        The maximum number of days between two full syncs of a table.
+
+    backend : _cache.QueryCache, default=None
+        The cache used for queries of tables that are not mirrored.
+    """
+
+    mirror_dir: str = ".warehouse_mirror"
+    tables: list | None = None
+    full_resync_days: float = 7
+    backend: object = None
+
+    def __post_init__(self):
+        if self.tables is None:
+            self.tables = MIRRORED_TABLES
+        self._tables = {
+            _cache._normalize(table.spec.query): table for table in self.tables
+        }
+        Path(self.mirror_dir).mkdir(parents=True, exist_ok=True)
+        # The tables already synced by this mirror.
+        self._synced = set()
+
+    def load(self, query, columns=None):
+        """Load a mirrored table, syncing it at its first load.
+
+        Parameters
+        ----------
+        query : str
+            The SQL query.
+
+        columns : list of str, default=None
+            The columns to return. If None, return the columns of the query.
+
+        Returns
+        -------
+        df : pandas.DataFrame or None
+            None when the table is not mirrored and not in the backend.
+        """
+        table = self._tables.get(_cache._normalize(query))
+        if table is None:
+            if self.backend is None:
+                return None
+            return self.backend.load(query, columns=columns)
+
+        columns = columns or list(table.spec.columns)
+        if table.spec.table in self._synced:
+            return pd.read_parquet(self._paths(table)[0], columns=columns)
+
+        df = self.sync(table)
+        self._synced.add(table.spec.table)
+        return df[columns]
+
+    def save(self, query, df, elapsed=None):
+        # Mirrored tables are saved when synced.
+        if _cache._normalize(query) not in self._tables and self.backend is not None:
+            self.backend.save(query, df, elapsed=elapsed)
+
+    def invalidate(self, query=None):
+        """Remove a mirrored table, or all of them when query is None.
+
+        The next sync is then a full resync.
+        """
+        if query is None:
+            tables = self.tables
+        else:
+            tables = [self._tables.get(_cache._normalize(query))]
+        for table in tables:
+            if table is None:
+                continue
+            for path in self._paths(table):
+                path.unlink(missing_ok=True)
+            self._synced.discard(table.spec.table)
+
+        if self.backend is not None:
+            self.backend.invalidate(query)
+
+    def sync(self, table):
+        """Fetch the rows updated since the last sync and merge them.
+
+        Parameters
+        ----------
+        table : MirroredTable
+
+        Returns
+        -------
+        df : pandas.DataFrame
+            The mirrored table, including the primary key and the watermark.
+        """
+        path, meta_path = self._paths(table)
+        query = table.spec_to_sync.query
+        meta = json.loads(meta_path.read_text()) if meta_path.exists() else None
+
+        needs_full_sync = (
+            meta is None
+            or not path.exists()
+            or meta["query"] != query
+            or table.watermark_column is None
+            or meta["watermark"] is None
+            or time() - meta["full_synced_at"] > self.full_resync_days * 24 * 3600
+        )
+
+        source = db.DBSourceWH()
+        # The mirror fetches directly from the warehouse.
+        with db.use_query_cache(None):
+            if not needs_full_sync:
+                delta_spec = dataclasses.replace(
+                    table.spec_to_sync,
+                    filters=table.spec_to_sync.filters + (
+                        f"{table.watermark_column} >= '{meta['watermark']}'",
+                    ),
+                )
+                try:
+                    delta = source.fetch(delta_spec.query, method="copy")
+                except psycopg2.Error as e:
+                    self._log_info("failed delta sync of", table.spec.table, f"-- {e}")
+                    needs_full_sync = True
+
+            if needs_full_sync:
+                try:
+                    df = source.fetch(query, method="copy")
+                except psycopg2.errors.UndefinedColumn as e:
+                    if table.watermark_column is None:
+                        raise
+                    # Without the watermark, the table can only be fully synced.
+                    self._log_info("no watermark for", table.spec.table, f"-- {e}")
+                    table = dataclasses.replace(table, watermark_column=None)
+                    query = table.spec_to_sync.query
+                    df = source.fetch(query, method="copy")
+                full_synced_at = time()
+                self._log_info("fully synced", table.spec.table)
+            else:
+                df = pd.read_parquet(path)
+                is_updated = df[table.primary_key].isin(delta[table.primary_key])
+                df = pd.concat([df.loc[~is_updated], delta], ignore_index=True)
+                full_synced_at = meta["full_synced_at"]
+                msg = f"-- {delta.shape[0]} rows updated"
+                self._log_info("synced", table.spec.table, msg)
+
+        watermark = None
+        if table.watermark_column is not None and df.shape[0] > 0:
+            watermark = pd.Timestamp(df[table.watermark_column].max()).isoformat()
+
+        df.to_parquet(path, index=False)
+        meta_path.write_text(
+            json.dumps(
+                dict(
+                    query=query,
+                    watermark=watermark,
+                    full_synced_at=full_synced_at,
+                    synced_at=time(),
+                )
+            )
+        )
+        return df
+
+    def _paths(self, table):
+        path = Path(self.mirror_dir) / f"{table.spec.table}.parquet"
+        return path, path.with_suffix(".json")
@@ -0,0 +1,149 @@
+"""
+Local cache of the models downloaded from the registry.
+
+Each model artifact is stored once, named after the SHA-256 of its content.
+A manifest per (model_name, model_version) records the hash of its artifact,
+so that a registered version is downloaded once, and its local copy is checked
+against the hash before being used. Only the most recently used versions are
+kept.
+"""
+import json
+import shutil
+import hashlib
+import tempfile
+from time import time
+from pathlib import Path
+from dataclasses import dataclass
+
+from . import _logs
+
+
+@dataclass
+class ModelCache(_logs.LogsMixin):
+    """Keep verified copies of the last used model versions on disk.
+
+    Parameters
+    ----------
+    cache_dir : str, default=".model_cache"
+        The directory of the artifacts and their manifests.
+
+    max_versions : int, default=3
+        The number of model versions kept, the least recently used ones are
+        removed first.
+    """
+
+    cache_dir: str = ".model_cache"
+    max_versions: int = 3
+
+    def __post_init__(self):
+        if self.max_versions < 1:
+            raise ValueError(
+                f"max_versions must be at least 1, got {self.max_versions}."
+            )
+        for path in [self._manifest_dir, self._blob_dir]:
+            path.mkdir(parents=True, exist_ok=True)
+
+    def get(self, model_name, model_version, download):
+        """Return the path of a verified model artifact, downloading it on misses.
+
+        Parameters
+        ----------
+        model_name : str
+            The name of the model in the registry.
+
+        model_version : str
+            The version of the model in the registry.
+
+        download : callable
+            Called as download(download_dir) on misses, downloading the model
+            in download_dir and returning the path of the artifact.
+
+        Returns
+        -------
+        path : pathlib.Path
+            The path of the artifact in the cache.
+        """
+        manifest_path = self._manifest_path(model_name, model_version)
+        manifest = (
+            json.loads(manifest_path.read_text()) if manifest_path.exists() else None
+        )
+
+        key = f"{model_name}:{model_version}"
+        if manifest is not None:
+            path = self._blob_path(manifest["sha256"])
+            if path.exists() and _get_sha256(path) == manifest["sha256"]:
+                self._log_info("hit", key, f"-- {manifest['sha256'][:12]}")
+                self._save_manifest(manifest_path, manifest)
+                return path
+            self._log_info("failed verification of", key)
+
+        with tempfile.TemporaryDirectory(dir=self.cache_dir) as tmp_dir:
+            start = time()
+            artifact_path = Path(download(tmp_dir))
+            sha256 = _get_sha256(artifact_path)
+            path = self._blob_path(sha256)
+            # Artifacts are moved in place atomically, so that a concurrent run
+            # never reads a partial copy.
+            tmp_path = path.with_suffix(".tmp")
+            shutil.move(artifact_path, tmp_path)
+            tmp_path.replace(path)
+        self._log_info("downloaded", key, f"in {time() - start:.1f}s -- {sha256[:12]}")
+
+        manifest = dict(
+            model_name=model_name,
+            model_version=str(model_version),
+            sha256=sha256,
+            filename=artifact_path.name,
+        )
+        self._save_manifest(manifest_path, manifest)
+        self._evict()
+        return path
+
+    def _evict(self):
+        manifests = sorted(
+            (
+                (json.loads(path.read_text()), path)
+                for path in self._manifest_dir.glob("*.json")
+            ),
+            key=lambda item: item[0]["used_at"],
+            reverse=True,
+        )
+        for manifest, manifest_path in manifests[self.max_versions:]:
+            manifest_path.unlink(missing_ok=True)
+            key = f"{manifest['model_name']}:{manifest['model_version']}"
+            self._log_info("evicted", key)
+
+        # Artifacts are shared between versions with the same content.
+        used = {manifest["sha256"] for manifest, _ in manifests[:self.max_versions]}
+        for path in self._blob_dir.glob("*.pkl"):
+            if path.stem not in used:
+                path.unlink(missing_ok=True)
+
+    def _save_manifest(self, manifest_path, manifest):
+        manifest = dict(manifest, used_at=time())
+        tmp_path = manifest_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(manifest))
+        tmp_path.replace(manifest_path)
+
+    @property
+    def _manifest_dir(self):
+        return Path(self.cache_dir) / "manifests"
+
+    @property
+    def _blob_dir(self):
+        return Path(self.cache_dir) / "blobs"
+
+    def _manifest_path(self, model_name, model_version):
+        key = hashlib.sha256(f"{model_name}\n{model_version}".encode()).hexdigest()
+        return self._manifest_dir / f"{key}.json"
+
+    def _blob_path(self, sha256):
+        return self._blob_dir / f"{sha256}.pkl"
+
+
+def _get_sha256(path, chunk_size=1024 ** 2):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
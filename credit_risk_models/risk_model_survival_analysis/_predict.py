@@ -1,15 +1,20 @@
 import uuid
+import resource
 from pathlib import Path
-from tqdm import tqdm
+from itertools import chain
+from contextlib import contextmanager, nullcontext
 import numpy as np
 import pandas as pd
 import pickle
 from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
 from scipy.interpolate import interp1d
 from sqlalchemy.types import Double, Uuid, String, DateTime
-from lime.lime_tabular import LimeTabularExplainer
 
 from . import _make_dataset
+from . import _lime
+from . import _model_cache
 from . import _utils
 from . import db
 from credit_risk_models.azure_credentials_keyvault.ml_client import (
@@ -17,6 +22,25 @@ from credit_risk_models.azure_credentials_keyvault.ml_client import (
 )
 
 
+PREDICTION_SQL_DTYPE = {
+    "prediction_id": Uuid(),
+    "batch_id": Uuid(),
+    "model_name": String(),
+    "model_version": String(),
+    "loan_id": String(),
+    "default_probability": Double(),
+    "date": DateTime(),
+}
+
+FEAT_IMPS_SQL_DTYPE = {
+    "feat_imp_id": Uuid(),
+    "prediction_id": Uuid(),
+    "name": String(),
+    "value": String(),
+    "contribution": Double(),
+}
+
+
 @dataclass
 class PredictTask:
     model_name : str
@@ -24,158 +48,332 @@ class PredictTask:
     prediction_table_name : str
     feat_imps_table_name : str
     dpd_limit : int = 240
+    # The number of processes computing the feature importances, sharded by loan.
+    # None means 1, -1 means all cores.
+    n_jobs : int | None = None
+    # The seed of the LIME perturbations.
+    random_state : int = 42
+    # The number of loans, drawn across all borrowers, whose feature statistics
+    # scale the LIME perturbations, see _make_dataset.DatasetMaker.sample_dataset.
+    lime_sample_size : int = 10_000
+    # The number of loans scored at once.
+    batch_size : int = 10_000
+    # When set, fail as soon as the peak memory of the process, checked once each
+    # batch is computed and before it is written, exceeds this number of MB. The
+    # tables are then left unchanged.
+    max_rss_mb : float | None = None
+    # The directory of the downloaded models, see _model_cache.ModelCache.
+    model_cache_dir : str = ".model_cache"
+    # The number of model versions kept in model_cache_dir.
+    max_cached_models : int = 3
 
     def run(self):
         """Fetch a model from a cloud registry, run prediction and store \
         them on warehouse.
         """
-        # We generate the predictions and push them on the warehouse.
-        self.ds = _make_dataset.DatasetMaker(is_training=False)
-        df = self.ds.dataset
+        # The model is loaded in the background while the tables are loaded and
+        # the first batch is featurized, and only waited for before scoring it.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            model_future = executor.submit(
+                _load_model,
+                self.model_name,
+                self.model_version,
+                cache_dir=self.model_cache_dir,
+                max_versions=self.max_cached_models,
+            )
+            self.ds = _make_dataset.DatasetMaker(is_training=False)
+            self.ds.prefetch(tables=["loans", "audits", "cars", "companies"])
+
+            # Loans are featurized, scored and explained by batches, and their
+            # predictions are written to staging tables as soon as they are
+            # computed, to bound memory. See _stage_tables.
+            batches = (
+                batch
+                for batch in self.ds.iter_dataset(chunk_rows=self.batch_size)
+                if batch.shape[0] > 0
+            )
+            first_batch = next(batches, None)
+            if first_batch is not None:
+                lime_sample = self.ds.sample_dataset(self.lime_sample_size)
+            self.model_dict = model_future.result()
 
-        print(f"Number of on-going loans to be predicted: {df.shape[0]}")
-        print(df.info())
+        if first_batch is None:
+            print("No on-going loans to be predicted.")
+            return
 
-        self.model_dict = _load_model(self.model_name, self.model_version)
         model = self.model_dict["model"]
 
         label_cols = ["event", "duration"]
         id_cols = ["carloan_id", "borrower_id"]
-        X = df.drop(columns=label_cols + id_cols)
-        
         vectorizer, estimator = model[0], model[-1]
-        X_trans = vectorizer.transform(X)
-
-        y_proba = estimator.predict_cumulative_incidence(X_trans)  # (n_samples, n_events, n_time_steps)
+        estimator.set_params(show_progressbar=False)
 
         # TODO: use bank provided termination limit of hardcoding it
         self.termination_limit = 150 
-        horizon = self.termination_limit - X_trans["loan_age_days"]
-        
-        indices = np.searchsorted(estimator.time_grid_, horizon)
-        y_proba_t = y_proba[np.arange(y_proba.shape[0]), :, indices]  # (n_samples, n_events)
-        default_proba_t = y_proba_t[:, 0] + y_proba_t[:, 2]  # (n_samples)
-
-        preds = X_trans.copy()
-        preds["loan_id"] = df["carloan_id"]
-        preds["prediction_id"] = [uuid.uuid4() for _ in range(preds.shape[0])]
-        preds["batch_id"] = uuid.uuid4()
-        preds["default_probability"] = default_proba_t
-        preds["model_name"] = self.model_dict["model_name"]
-        preds["model_version"] = self.model_dict["model_version"]
-        preds["date"] = pd.Timestamp.now().strftime(_utils.UTC_DATETIME_FORMAT)
-
-        prediction_sql_dtype = {
-            "prediction_id": Uuid(),
-            "batch_id": Uuid(),
-            "model_name": String(),
-            "model_version": String(),
-            "loan_id": String(),
-            "default_probability": Double(),
-            "date": DateTime(),
-        }
-        _write_table(preds, prediction_sql_dtype, self.prediction_table_name)
-
-        X_trans["prediction_id"] = preds["prediction_id"]
-        feat_imps = self._get_feat_imps(X_trans, estimator, y_proba_t, horizon)
-        feat_imps["feat_imp_id"] = [uuid.uuid4() for _ in range(feat_imps.shape[0])]
-        feat_imps.sort_values("prediction_id", inplace=True)
-        feat_mapping_sql_dtype = {
-            "feat_imp_id": Uuid(),
-            "prediction_id": Uuid(),
-            "name": String(),
-            "value": String(),
-            "contribution": Double(),
-        }
-        _write_table(feat_imps, feat_mapping_sql_dtype, self.feat_imps_table_name)
-    
-    def _get_feat_imps(self, X_trans, estimator, y_proba_t, horizon):
-
-        estimator.set_params(show_progressbar=False)
-
-        preds = X_trans.melt(
-            id_vars="prediction_id", var_name="name",
-        ).sort_values("prediction_id")
 
-        prediction_ids = X_trans.pop("prediction_id")
+        batch_id = uuid.uuid4()
+        date = pd.Timestamp.now().strftime(_utils.UTC_DATETIME_FORMAT)
 
+        # LIME perturbations are scaled by the statistics of a sample drawn across
+        # all borrowers, so that they don't depend on batch_size, and are shared
+        # by all batches.
         # TODO: Does it needs to use X_train instead? To investigate.
-        explainer = LimeTabularExplainer(
-            training_data=X_trans.values,
-            feature_names=X_trans.columns.tolist(),
-            mode="classification",
-            discretize_continuous=False,
+        explainer = _lime.BatchLimeExplainer(
+            training_data=vectorizer.transform(
+                lime_sample.drop(columns=label_cols + id_cols)
+            ),
+            random_state=self.random_state,
         )
 
+        n_jobs = _make_dataset._get_n_jobs(self.n_jobs)
+        n_loans = 0
+        table_names = [self.prediction_table_name, self.feat_imps_table_name]
+        with (
+            _stage_tables(table_names, batch_id) as staging_names,
+            _get_explain_executor(
+                self.model_dict["model_path"], explainer, n_jobs
+            ) as explain_executor,
+        ):
+            for idx, batch in enumerate(chain([first_batch], batches)):
+                X_trans_batch = vectorizer.transform(
+                    batch.drop(columns=label_cols + id_cols)
+                )
+                horizon = self.termination_limit - X_trans_batch["loan_age_days"]
+
+                # Of shape (n_samples, n_events).
+                y_proba_t_batch = _utils.predict_at_horizons(
+                    estimator, X_trans_batch, horizon
+                )
+                # Of shape (n_samples,).
+                default_proba_t = y_proba_t_batch[:, 0] + y_proba_t_batch[:, 2]
+
+                preds = pd.DataFrame({
+                    "loan_id": batch["carloan_id"].to_numpy(),
+                    "prediction_id": [uuid.uuid4() for _ in range(batch.shape[0])],
+                    "batch_id": batch_id,
+                    "default_probability": default_proba_t,
+                    "model_name": self.model_dict["model_name"],
+                    "model_version": self.model_dict["model_version"],
+                    "date": date,
+                })
+
+                contributions = self._get_contributions(
+                    X_trans_batch,
+                    estimator,
+                    explainer,
+                    y_proba_t_batch,
+                    horizon,
+                    explain_executor,
+                    n_jobs,
+                )
+                feat_imps = _get_feat_imps(
+                    X_trans_batch.assign(
+                        prediction_id=preds["prediction_id"].to_numpy()
+                    ),
+                    contributions,
+                )
+                self._check_memory(f"batch {idx + 1} of {batch.shape[0]} loans")
+
+                if_exists = "replace" if idx == 0 else "append"
+                _write_table(
+                    preds,
+                    PREDICTION_SQL_DTYPE,
+                    staging_names[self.prediction_table_name],
+                    if_exists=if_exists,
+                )
+                _write_table(
+                    feat_imps,
+                    FEAT_IMPS_SQL_DTYPE,
+                    staging_names[self.feat_imps_table_name],
+                    if_exists=if_exists,
+                )
+                n_loans += batch.shape[0]
+
+        print(f"Number of on-going loans predicted: {n_loans}")
+
+    def _get_contributions(
+        self, X_trans, estimator, explainer, y_proba_t, horizon, executor, n_jobs
+    ):
         # We only care about feature importance for the default classes.
         label_indices = np.argmax(y_proba_t[:, [0, 2]], axis=1) * 2
 
-        print("Getting feature importance from Lime")
-        results = []
-        for idx in tqdm(range(X_trans.shape[0])):
-            
-            # Has to be set for predict proba
-            estimator.set_params(time_horizon=horizon.iloc[idx])
-
-            exp = explainer.explain_instance(
-                X_trans.values[idx, :],
-                estimator.predict_proba,
-                num_features=X_trans.shape[1],
-                labels=(0, 1, 2),
+        X = X_trans.to_numpy(dtype="float64")
+        if executor is not None:
+            return _explain_parallel(
+                X,
+                horizons=horizon.to_numpy(),
+                labels=label_indices,
+                executor=executor,
+                n_jobs=n_jobs,
             )
 
-            label = label_indices[idx]
-            feats_contrib = exp.as_list(label=label)
+        return explainer.explain(
+            X,
+            estimator.predict_cumulative_incidence,
+            horizons=horizon.to_numpy(),
+            labels=label_indices,
+            verbose=True,
+        )
 
-            for (feat_name, contrib) in feats_contrib:
-                results.append(
-                    dict(
-                        prediction_id=prediction_ids.iloc[idx],
-                        name=feat_name,
-                        contribution=contrib,
-                    )
-                )
+    def _check_memory(self, step):
+        # ru_maxrss is in KB on Linux.
+        peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f"Peak RSS after {step}: {peak_rss_mb:.0f}MB")
+        if self.max_rss_mb is not None and peak_rss_mb > self.max_rss_mb:
+            raise MemoryError(
+                f"Peak RSS of {peak_rss_mb:.0f}MB exceeds max_rss_mb="
+                f"{self.max_rss_mb} after {step}. Reduce batch_size "
+                f"(currently {self.batch_size})."
+            )
 
-        results = pd.DataFrame(results)
-        preds = preds.merge(results, on=["prediction_id", "name"], how="left")
 
-        return preds
+def _get_feat_imps(X_trans, contributions):
+    """Return the value and the contribution of each feature of each prediction.
+    """
+    feat_imps = X_trans.melt(id_vars="prediction_id", var_name="name")
+    # Melting stacks the features one after the other.
+    feat_imps["contribution"] = contributions.ravel(order="F")
+    feat_imps["feat_imp_id"] = [uuid.uuid4() for _ in range(feat_imps.shape[0])]
+    return feat_imps.sort_values("prediction_id", kind="stable")
 
 
-def _load_model(model_name, model_version):
+def _load_model(model_name, model_version, cache_dir=".model_cache", max_versions=3):
     ml_client = get_ml_client()
 
-    download_path = Path(".") / "downloaded_model"
     model_info = ml_client.models.get(
         name=model_name,
         version=model_version,
     )
-    ml_client.models.download(
-        name=model_name,
-        version=model_version,
-        download_path=download_path,
-    )
-    artifact_dir_path = Path(download_path) / model_name
 
-    # Get the last training run
-    run_path = sorted(artifact_dir_path.glob("training_run_*"))[-1]
+    def download(download_path):
+        ml_client.models.download(
+            name=model_name,
+            version=model_version,
+            download_path=download_path,
+        )
+        artifact_dir_path = Path(download_path) / model_name
+
+        # Get the last training run
+        run_path = sorted(artifact_dir_path.glob("training_run_*"))[-1]
 
-    model_path = run_path / "model.pkl"
-    model = pickle.load(open(model_path, "rb"))
+        return run_path / "model.pkl"
+
+    # The model is only downloaded when no verified copy of this version is cached.
+    cache = _model_cache.ModelCache(cache_dir=cache_dir, max_versions=max_versions)
+    model_path = cache.get(model_info.name, model_info.version, download)
+    with open(model_path, "rb") as f:
+        model = pickle.load(f)
 
     return dict(
         model=model,
+        model_path=model_path,
         model_name=model_info.name,
         model_version=model_info.version,
     )
 
 
-def _write_table(df, sql_dtype, table_name):
+def _get_explain_executor(model_path, explainer, n_jobs):
+    """Return a pool of processes explaining predictions, each loading the model
+    once, or a null context when n_jobs is 1.
+    """
+    if n_jobs == 1:
+        return nullcontext()
+    return ProcessPoolExecutor(
+        max_workers=n_jobs,
+        initializer=_init_explain_worker,
+        initargs=(model_path, explainer),
+    )
+
+
+def _explain_parallel(X, horizons, labels, executor, n_jobs):
+    """Explain predictions on a pool of _get_explain_executor.
+
+    X is shared with the workers through shared memory. Loans are sorted by
+    horizon before being sharded, so that each worker scores the perturbations
+    at few horizons. All workers use the same explainer, so that the
+    explanations don't depend on n_jobs.
+    """
+    order = np.argsort(horizons, kind="stable")
+    shards = [shard for shard in np.array_split(order, n_jobs) if shard.shape[0] > 0]
+
+    shm = shared_memory.SharedMemory(create=True, size=max(X.nbytes, 1))
+    try:
+        np.ndarray(X.shape, dtype=X.dtype, buffer=shm.buf)[:] = X
+        futures = [
+            executor.submit(
+                _explain_shard,
+                shm.name,
+                X.shape,
+                X.dtype.str,
+                shard,
+                horizons[shard],
+                labels[shard],
+            )
+            for shard in shards
+        ]
+        contributions = np.empty(X.shape, dtype="float64")
+        for shard, future in zip(shards, futures):
+            contributions[shard] = future.result()
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return contributions
+
+
+# The state of an explanation worker, set once by _init_explain_worker.
+_WORKER = {}
+
+
+def _init_explain_worker(model_path, explainer):
+    with open(model_path, "rb") as f:
+        estimator = pickle.load(f)[-1]
+    estimator.set_params(show_progressbar=False)
+    _WORKER.update(estimator=estimator, explainer=explainer)
+
+
+def _explain_shard(shm_name, shape, dtype, indices, horizons, labels):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        X = np.ndarray(shape, dtype=dtype, buffer=shm.buf)[indices]
+    finally:
+        shm.close()
+    return _WORKER["explainer"].explain(
+        X,
+        _WORKER["estimator"].predict_cumulative_incidence,
+        horizons=horizons,
+        labels=labels,
+    )
+
+
+@contextmanager
+def _stage_tables(table_names, batch_id):
+    """Yield the name of a staging table for each table name.
+
+    On exit, the staging tables replace the tables, in a single transaction. On
+    errors, they are dropped, so that the tables are left unchanged.
+    """
+    staging_names = {
+        table_name: f"{table_name[:40]}_staging_{batch_id.hex[:8]}"
+        for table_name in table_names
+    }
+    try:
+        yield staging_names
+    except BaseException:
+        for staging_name in staging_names.values():
+            db.DBSourceRisk().delete(staging_name, schema="risks", missing_ok=True)
+        raise
+    db.DBSourceRisk().replace_tables(staging_names, schema="risks")
+
+
+def _write_table(df, sql_dtype, table_name, if_exists="replace"):
     df = df[list(sql_dtype)]
 
     return db.DBSourceRisk().write_df(
         df,
         table_name=table_name,
         schema="risks",
+        if_exists=if_exists,
         dtype=sql_dtype,
+        method="copy",
     )
@@ -1,6 +1,7 @@
 import numpy as np
 from sklearn.pipeline import Pipeline
 from sklearn.base import check_is_fitted
+from sklearn.utils import _safe_indexing
 
 FOLDER_DATETIME_FORMAT = "%Y-%m-%d_%H_%M_%S"
 UTC_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
@@ -12,6 +13,16 @@ class CumulativeIncidencePipeline(Pipeline):
         for _, _, transformer in self._iter(with_final=False):
             Xt = transformer.transform(Xt)
         return self.steps[-1][1].predict_cumulative_incidence(Xt, times)
+
+    def predict_at_horizons(self, X, horizons):
+        """Predict the cumulative incidence of each sample at its own horizon.
+
+        See predict_at_horizons.
+        """
+        Xt = X
+        for _, _, transformer in self._iter(with_final=False):
+            Xt = transformer.transform(Xt)
+        return predict_at_horizons(self.steps[-1][1], Xt, horizons)
     
     @property
     def time_grid(self):
@@ -20,6 +31,58 @@ class CumulativeIncidencePipeline(Pipeline):
         return model.time_grid_
 
 
+def predict_at_horizons(estimator, X, horizons):
+    """Predict the cumulative incidence of each sample at its own horizon.
+
+    Instead of predicting all the times of the time grid for all samples, only
+    the two grid points around the horizon of each sample are predicted, and
+    linearly interpolated. Horizons outside of the grid get the value of the
+    closest grid point.
+
+    Parameters
+    ----------
+    estimator : fitted estimator
+        Having a time_grid_ and a predict_cumulative_incidence(X, times) method,
+        e.g. hazardous.SurvivalBoost.
+
+    X : array-like of shape (n_samples, n_features)
+        The samples, already transformed.
+
+    horizons : array-like of shape (n_samples,)
+        The time at which each sample is predicted.
+
+    Returns
+    -------
+    y_proba : numpy.ndarray of float32 of shape (n_samples, n_events + 1)
+    """
+    check_is_fitted(estimator, "time_grid_")
+    time_grid = np.asarray(estimator.time_grid_, dtype="float64")
+    horizons = np.asarray(horizons, dtype="float64")
+
+    # The index of the first grid point after each horizon.
+    upper = np.searchsorted(time_grid, horizons).clip(1, time_grid.shape[0] - 1)
+    lower = upper - 1
+    weights = (
+        (horizons - time_grid[lower]) / (time_grid[upper] - time_grid[lower])
+    ).clip(0, 1)
+
+    # Samples sharing the same grid points are predicted together.
+    y_proba = None
+    for idx in np.unique(upper):
+        indices = np.flatnonzero(upper == idx)
+        proba = estimator.predict_cumulative_incidence(
+            _safe_indexing(X, indices), times=time_grid[[idx - 1, idx]]
+        )
+        if y_proba is None:
+            y_proba = np.zeros((horizons.shape[0], proba.shape[1]), dtype="float32")
+        weight = weights[indices, None]
+        y_proba[indices] = (1 - weight) * proba[:, :, 0] + weight * proba[:, :, 1]
+
+    if y_proba is None:
+        y_proba = np.zeros((0, 0), dtype="float32")
+    return y_proba
+
+
 def make_recarray(y):
     # This is an annoying trick to make scikit-survival happy.
     event = y["event"].values
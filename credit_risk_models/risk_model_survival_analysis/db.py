@@ -1,5 +1,14 @@
+import json
+import uuid
+import tempfile
+from decimal import Decimal
 from time import time
+from contextlib import contextmanager
+from collections import Counter
+import threading
 import pandas as pd
+import pyarrow as pa
+from pyarrow import csv as pa_csv
 import psycopg2
 from sqlalchemy import create_engine
 from dataclasses import dataclass, asdict
@@ -9,6 +18,152 @@ from credit_risk_models.azure_credentials_keyvault.db_credentials import (
 )
 from . import _logs
 
+# The number of rows per chunk when streaming large tables.
+CHUNKSIZE = 100_000
+
+# COPY results larger than this, in bytes, are spooled to disk.
+_COPY_SPOOL_SIZE = 256 * 1024 ** 2
+
+# The number of bytes of COPY output parsed and converted at once.
+_COPY_BLOCK_SIZE = 64 * 1024 ** 2
+
+# The json and jsonb types, which psycopg parses into Python objects.
+_JSON_OIDS = (114, 3802)
+
+# The on-disk cache used by DBSource.fetch, see use_query_cache. It is local to
+# each thread, so that loaders running concurrently don't override each other's
+# cache.
+_local = threading.local()
+
+
+@contextmanager
+def use_query_cache(cache):
+    """Serve DBSource.fetch results from a cache within this context, in the \
+    current thread.
+
+    Parameters
+    ----------
+    cache : _cache.QueryCache, _cache.MemoryQueryCache or None
+        If None, queries are always sent to the database.
+    """
+    previous = getattr(_local, "query_cache", None)
+    _local.query_cache = cache
+    try:
+        yield cache
+    finally:
+        _local.query_cache = previous
+
+
+@dataclass
+class ConnectionPool:
+    """A process-wide cache of credentials, connections and engines.
+
+    Credentials are fetched from the Key Vault at most once per
+    credentials_ttl seconds. Connections are reused per database role and per
+    thread, so that concurrent threads never share a transaction. Engines are
+    reused per database role.
+
+    Parameters
+    ----------
+    credentials_ttl : float, default=3600
+        The number of seconds before credentials are fetched again.
+    """
+
+    credentials_ttl: float = 3600
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+        self._credentials = None
+        self._credentials_time = None
+        self._connections = {}
+        self._engines = {}
+        self._stats = Counter()
+
+    def get_credentials(self):
+        with self._lock:
+            is_expired = (
+                self._credentials is None
+                or time() - self._credentials_time > self.credentials_ttl
+            )
+            if is_expired:
+                self._credentials = get_db_credentials()
+                self._credentials_time = time()
+                self._stats["credentials_fetched"] += 1
+            else:
+                self._stats["credentials_reused"] += 1
+            return self._credentials
+
+    def get_connection(self, params):
+        key = (_get_params_key(params), threading.get_ident())
+        with self._lock:
+            conn = self._connections.get(key)
+            if conn is None or conn.closed:
+                conn = psycopg2.connect(**params)
+                self._connections[key] = conn
+                self._stats["connections_opened"] += 1
+            else:
+                self._stats["connections_reused"] += 1
+            return conn
+
+    def get_engine(self, params):
+        key = _get_params_key(params)
+        with self._lock:
+            engine = self._engines.get(key)
+            if engine is None:
+                engine = create_engine(
+                    f"postgresql+psycopg2://{params['user']}:{params['password']}"
+                    f"@{params['host']}:{params['port']}/{params['dbname']}"
+                )
+                self._engines[key] = engine
+                self._stats["engines_opened"] += 1
+            else:
+                self._stats["engines_reused"] += 1
+            return engine
+
+    def get_stats(self):
+        """Return the number of fetched and reused credentials, connections \
+        and engines.
+        """
+        with self._lock:
+            stats = {
+                f"{resource}_{action}": 0
+                for resource, action in [
+                    ("credentials", "fetched"), ("credentials", "reused"),
+                    ("connections", "opened"), ("connections", "reused"),
+                    ("engines", "opened"), ("engines", "reused"),
+                ]
+            }
+            stats.update(self._stats)
+            stats["connections_alive"] = sum(
+                not conn.closed for conn in self._connections.values()
+            )
+            return stats
+
+    def close(self):
+        """Close all connections and engines, and forget the credentials.
+        """
+        with self._lock:
+            for conn in self._connections.values():
+                conn.close()
+            for engine in self._engines.values():
+                engine.dispose()
+            self._connections.clear()
+            self._engines.clear()
+            self._credentials = None
+
+
+def _get_params_key(params):
+    return tuple(sorted(params.items()))
+
+
+_pool = ConnectionPool()
+
+
+def get_pool_stats():
+    """Return the statistics of the process-wide connection pool.
+    """
+    return _pool.get_stats()
+
 
 def _register_age_type_psycopg():
     """Prevent psycopg from raising an error when the age is out of bound.
@@ -25,6 +180,39 @@ def _register_age_type_psycopg():
     psycopg2.extensions.register_type(date2str)
 
 
+@dataclass(frozen=True)
+class QuerySpec:
+    """The columns and filters a loader needs from a single table.
+
+    Declaring them lets the database project and filter rows before the
+    transfer, instead of fetching the whole table with SELECT * and dropping
+    columns in pandas.
+
+    Parameters
+    ----------
+    table : str
+        The name of the table.
+
+    columns : tuple of str
+        The columns to select, quoted as identifiers.
+
+    filters : tuple of str, default=()
+        SQL predicates, combined with AND.
+    """
+
+    table: str
+    columns: tuple
+    filters: tuple = ()
+
+    @property
+    def query(self):
+        columns = ", ".join(f'"{col}"' for col in self.columns)
+        query = f"SELECT {columns} FROM {self.table}"
+        if self.filters:
+            query += " WHERE " + " AND ".join(f"({f})" for f in self.filters)
+        return query
+
+
 @dataclass
 class DBSource(_logs.LogsMixin):
     """A simple PostgreSQL connector for dataframes."""
@@ -36,14 +224,19 @@ class DBSource(_logs.LogsMixin):
     password: str
 
     def __post_init__(self):
-        self.conn = psycopg2.connect(**asdict(self))
-        self.engine = create_engine(
-            f"postgresql+psycopg2://{self.user}:{self.password}"
-            f"@{self.host}:{self.port}/{self.dbname}"
-        )
         _register_age_type_psycopg()
 
-    def fetch(self, query, columns_renaming=None):
+    # The connection and the engine are taken lazily from the process-wide
+    # pool, so that queries served from the cache don't need them.
+    @property
+    def conn(self):
+        return _pool.get_connection(asdict(self))
+
+    @property
+    def engine(self):
+        return _pool.get_engine(asdict(self))
+
+    def fetch(self, query, columns_renaming=None, chunksize=None, method="cursor"):
         """Use a SQL query to fetch a dataframe.
 
         Parameters
@@ -55,24 +248,186 @@ class DBSource(_logs.LogsMixin):
             The mapping to rename and select columns, to keep
             the SQL query as minimal as possible.
 
+        chunksize : int, default=None
+            If set, stream the rows from a server-side cursor in chunks of
+            this size, see fetch_chunks. This bounds the memory used by
+            intermediate Python tuples to a single chunk.
+            Only used when method="cursor".
+
+        method : {"cursor", "copy"}, default="cursor"
+            - cursor: Build the dataframe from the rows returned by psycopg.
+            - copy: Bulk read the result with COPY, see fetch_copy. This is
+              faster for full-table pulls.
+
         Returns
         -------
         df : pandas.DataFrame
         """
+        if method not in ("cursor", "copy"):
+            raise ValueError(f"method must be 'cursor' or 'copy', got {method!r}.")
+
+        cache = getattr(_local, "query_cache", None)
+        if cache is None:
+            df = self._fetch(query, chunksize, method)
+        else:
+            columns = list(columns_renaming) if columns_renaming is not None else None
+            # Hold the query lock while fetching, so that concurrent loaders
+            # sending the same query wait for the first result.
+            with cache.lock(query):
+                df = cache.load(query, columns=columns)
+                if df is None:
+                    start = time()
+                    df = self._fetch(query, chunksize, method)
+                    cache.save(query, df, elapsed=time() - start)
+
+        if columns_renaming is not None:
+            cols = list(columns_renaming.values())
+            df = df.rename(columns=columns_renaming)[cols]
+
+        return df
+
+    def _fetch(self, query, chunksize, method):
+        if method == "copy":
+            return self.fetch_copy(query)
+
+        if chunksize is not None:
+            return _concat_chunks(self.fetch_chunks(query, chunksize=chunksize))
+
         start = time()
-        with self.conn.cursor() as cursor:
+        conn = self.conn
+        # Pooled connections are shared, so each query runs in its own
+        # transaction, committed or rolled back on exit.
+        with conn, conn.cursor() as cursor:
             cursor.execute(query)
             rows = cursor.fetchall()
             columns = [desc[0] for desc in cursor.description]
         end = time()
-        msg = f"-- Took {end-start:.1f}s"
+        msg = f"-- Took {end-start:.1f}s, {len(rows)} rows x {len(columns)} columns"
         self._log_info("fetched", query, msg)
 
-        df = pd.DataFrame(rows, columns=columns)
+        return pd.DataFrame(rows, columns=columns)
 
-        if columns_renaming is not None:
-            cols = list(columns_renaming.values())
-            df = df.rename(columns=columns_renaming)[cols]
+    def fetch_chunks(self, query, chunksize=CHUNKSIZE, itersize=None):
+        """Stream the result of a SQL query as dataframe chunks.
+
+        Use a named (server-side) cursor, so that rows are transferred from
+        the database as they are consumed instead of all at once.
+
+        Parameters
+        ----------
+        query : str
+            The SQL query.
+
+        chunksize : int, default=CHUNKSIZE
+            The number of rows of each dataframe chunk.
+
+        itersize : int, default=None
+            The number of rows fetched per network round trip.
+            If None, use chunksize.
+
+        Yields
+        ------
+        df : pandas.DataFrame
+        """
+        start = time()
+        n_rows = 0
+        conn = self.conn
+        cursor_name = f"fetch_chunks_{uuid.uuid4().hex}"
+        with conn, conn.cursor(name=cursor_name) as cursor:
+            cursor.itersize = itersize or chunksize
+            cursor.execute(query)
+            while True:
+                rows = cursor.fetchmany(chunksize)
+                # The description of a named cursor is only available after
+                # the first fetch.
+                columns = [desc[0] for desc in cursor.description]
+                if not rows:
+                    if n_rows == 0:
+                        yield pd.DataFrame(columns=columns)
+                    break
+                n_rows += len(rows)
+                yield pd.DataFrame(rows, columns=columns)
+        end = time()
+        msg = f"-- Took {end-start:.1f}s, {n_rows} rows"
+        self._log_info("streamed", query, msg)
+
+    def fetch_copy(self, query):
+        """Bulk read the result of a SQL query with COPY ... TO STDOUT.
+
+        The result is transferred as CSV, spooled to disk when large, and
+        parsed by the Arrow CSV reader instead of building Python tuples row by
+        row. The CSV is parsed and converted to pandas by blocks of
+        _COPY_BLOCK_SIZE bytes, so that the whole result is never held as an
+        Arrow table next to its pandas copy. Columns are typed from their
+        PostgreSQL types, to get the same dtypes as fetch: dates are kept as
+        strings (see _register_age_type_psycopg), timestamps with time zones are
+        converted to UTC, and types without a dedicated conversion are kept as
+        strings.
+
+        Parameters
+        ----------
+        query : str
+            The SQL query, without a trailing semicolon.
+
+        Returns
+        -------
+        df : pandas.DataFrame
+        """
+        start = time()
+        conn = self.conn
+        with conn, conn.cursor() as cursor:
+            # Get the column types without running the whole query.
+            cursor.execute(f"SELECT * FROM ({query}) AS q LIMIT 0")
+            type_codes = {desc[0]: desc[1] for desc in cursor.description}
+
+            with tempfile.SpooledTemporaryFile(max_size=_COPY_SPOOL_SIZE) as buffer:
+                cursor.copy_expert(
+                    f"COPY ({query}) TO STDOUT "
+                    "WITH (FORMAT csv, HEADER true, NULL '\\N')",
+                    buffer,
+                )
+                n_bytes = buffer.tell()
+                buffer.seek(0)
+                convert_options = pa_csv.ConvertOptions(
+                    column_types={
+                        col: _get_arrow_type(type_code)
+                        for col, type_code in type_codes.items()
+                    },
+                    null_values=["\\N"],
+                    true_values=["t"],
+                    false_values=["f"],
+                    strings_can_be_null=True,
+                    quoted_strings_can_be_null=False,
+                )
+                reader = pa_csv.open_csv(
+                    buffer,
+                    read_options=pa_csv.ReadOptions(block_size=_COPY_BLOCK_SIZE),
+                    convert_options=convert_options,
+                )
+                chunks = [
+                    _convert_copy_chunk(
+                        pa.Table.from_batches([batch], schema=reader.schema),
+                        type_codes,
+                    )
+                    for batch in reader
+                ]
+
+        if chunks:
+            df = pd.concat(chunks, ignore_index=True)
+        else:
+            df = _convert_copy_chunk(reader.schema.empty_table(), type_codes)
+
+        end = time()
+        msg = (
+            f"-- Took {end-start:.1f}s, {df.shape[0]} rows x "
+            f"{df.shape[1]} columns, {n_bytes / 1024 ** 2:.1f}MB"
+        )
+        self._log_info("copied", query, msg)
+
+        for col in type_codes:
+            if df[col].isnull().all():
+                # psycopg returns None for all-null columns, whatever their type.
+                df[col] = pd.Series([None] * df.shape[0], dtype=object)
 
         return df
 
@@ -84,6 +439,7 @@ class DBSource(_logs.LogsMixin):
         if_exists="replace",
         index=False,
         dtype=None,
+        method="to_sql",
     ):
         """Write a dataframe to a table.
 
@@ -109,21 +465,113 @@ class DBSource(_logs.LogsMixin):
 
         index : bool, default=False
             Write DataFrame index as a column.
+
+        dtype : dict, default=None
+            The SQL types of columns, see pandas.DataFrame.to_sql.
+
+        method : {'to_sql', 'copy'}, default='to_sql'
+            - to_sql: Insert rows with pandas.DataFrame.to_sql.
+            - copy: Bulk load rows with COPY FROM STDIN. The table is created
+              by pandas with the same dtype mapping. With if_exists='replace',
+              rows are loaded into a staging table which then atomically
+              replaces the table, so readers never see a partial table.
         """
-        n_rows = dataframe.to_sql(
-            table_name,
-            schema=schema,
-            con=self.engine,
-            if_exists=if_exists,
-            index=index,
-            dtype=dtype,
-        )
+        start = time()
+        if method == "to_sql":
+            n_rows = dataframe.to_sql(
+                table_name,
+                schema=schema,
+                con=self.engine,
+                if_exists=if_exists,
+                index=index,
+                dtype=dtype,
+            )
+        elif method == "copy":
+            n_rows = self._write_df_copy(
+                dataframe, table_name, schema, if_exists, index, dtype
+            )
+        else:
+            raise ValueError(f"method must be 'to_sql' or 'copy', got {method!r}.")
+        end = time()
+
         path = f"{schema}.{table_name}" if schema is not None else table_name
         print(dataframe.dtypes)
-        self._log_info("wrote", path)
+        msg = f"-- Took {end-start:.1f}s, {dataframe.shape[0]} rows"
+        self._log_info("wrote", path, msg)
         return n_rows
 
-    def delete(self, table_name, schema=None):
+    def _write_df_copy(self, dataframe, table_name, schema, if_exists, index, dtype):
+        if if_exists not in ("replace", "append", "fail"):
+            raise ValueError(
+                "if_exists must be 'replace', 'append' or 'fail', "
+                f"got {if_exists!r}."
+            )
+        if index:
+            dataframe = dataframe.reset_index()
+
+        if if_exists == "replace":
+            target_name = f"{table_name[:40]}_staging_{uuid.uuid4().hex[:8]}"
+        else:
+            target_name = table_name
+
+        # A single transaction, so that the swap of the staging table is atomic
+        # and a failed load leaves the database unchanged.
+        with self.engine.begin() as connection:
+            quote = connection.dialect.identifier_preparer.quote
+            path = _get_table_path(connection, target_name, schema)
+
+            # Let pandas create the table, to keep the same SQL types as to_sql.
+            dataframe.head(0).to_sql(
+                target_name,
+                schema=schema,
+                con=connection,
+                if_exists=if_exists,
+                index=False,
+                dtype=dtype,
+            )
+
+            with tempfile.SpooledTemporaryFile(
+                max_size=_COPY_SPOOL_SIZE, mode="w+"
+            ) as buffer:
+                dataframe.to_csv(buffer, index=False, header=False, na_rep="\\N")
+                buffer.seek(0)
+                columns = ", ".join(quote(col) for col in dataframe.columns)
+                with connection.connection.cursor() as cursor:
+                    cursor.copy_expert(
+                        f"COPY {path} ({columns}) FROM STDIN "
+                        "WITH (FORMAT csv, NULL '\\N')",
+                        buffer,
+                    )
+
+            if if_exists == "replace":
+                _replace_table(connection, table_name, target_name, schema)
+
+        return dataframe.shape[0]
+
+    def replace_tables(self, tables, schema=None):
+        """Replace tables by staging tables, in a single transaction.
+
+        Readers see either all the old tables or all the new ones.
+
+        Parameters
+        ----------
+        tables : dict of str
+            The name of the staging table replacing each table, by table name.
+            The staging tables are renamed to the table names.
+
+        schema : str, default=None
+            Specify the schema (if database flavor supports this).
+            If None, use default schema.
+        """
+        with self.engine.begin() as connection:
+            for table_name, staging_name in tables.items():
+                _replace_table(connection, table_name, staging_name, schema)
+
+        for table_name, staging_name in tables.items():
+            path = f"{schema}.{table_name}" if schema is not None else table_name
+            self._log_info("replaced", path, f"-- by {staging_name}")
+
+    def delete(self, table_name, schema=None, missing_ok=False):
         """Delete a table.
 
         Parameters
@@ -134,17 +582,22 @@ class DBSource(_logs.LogsMixin):
         schema : str, default=None
             Specify the schema (if database flavor supports this).
             If None, use default schema.
+
+        missing_ok : bool, default=False
+            Whether to ignore a missing table instead of raising an error.
         """
         path = f"{schema}.{table_name}" if schema is not None else table_name
-        with self.conn.cursor() as cursor:
-            cursor.execute(f"DROP TABLE {path}")
+        if_exists = "IF EXISTS " if missing_ok else ""
+        conn = self.conn
+        with conn, conn.cursor() as cursor:
+            cursor.execute(f"DROP TABLE {if_exists}{path}")
         self._log_info("deleted", path)
 
     def _log_info(self, action, path, extra=""):
         print(f"{self.__class__.__name__} {action} {path} {extra}")
 
     def _fetch_credentials(self):
-        credentials = get_db_credentials()
+        credentials = _pool.get_credentials()
         return {
             "host": credentials["host"],
             "port": credentials["port"],
@@ -174,3 +627,76 @@ class DBSourceRisk(DBSource):
     def __init__(self):
         credentials = self._fetch_credentials()
         super().__init__(**credentials)
+
+
+def _get_table_path(connection, table_name, schema):
+    quote = connection.dialect.identifier_preparer.quote
+    if schema is None:
+        return quote(table_name)
+    return f"{quote(schema)}.{quote(table_name)}"
+
+
+def _replace_table(connection, table_name, staging_name, schema):
+    """Drop a table and rename a staging table to it, within the transaction of
+    connection.
+    """
+    quote = connection.dialect.identifier_preparer.quote
+    connection.exec_driver_sql(
+        f"DROP TABLE IF EXISTS {_get_table_path(connection, table_name, schema)}"
+    )
+    connection.exec_driver_sql(
+        f"ALTER TABLE {_get_table_path(connection, staging_name, schema)} "
+        f"RENAME TO {quote(table_name)}"
+    )
+
+
+def _concat_chunks(chunks):
+    """Concatenate dataframe chunks, inferring dtypes as if the rows were fetched \
+    at once.
+
+    A chunk whose column only has nulls gets an object dtype, while the same
+    column can be numeric or datetime in other chunks.
+    """
+    chunks = list(chunks)
+    mixed_cols = [
+        col for col in chunks[0].columns
+        if len({chunk[col].dtype for chunk in chunks}) > 1
+    ]
+    chunks = [chunk.astype({col: object for col in mixed_cols}) for chunk in chunks]
+    df = pd.concat(chunks, ignore_index=True)
+
+    # Only mixed columns are inferred again, from their Python objects.
+    for col in mixed_cols:
+        df[col] = pd.Series(df[col].tolist())
+    return df
+
+
+def _convert_copy_chunk(table, type_codes):
+    """Convert a block of COPY output to pandas, with the Python objects psycopg \
+    would return for decimals and json.
+    """
+    df = table.to_pandas(coerce_temporal_nanoseconds=True)
+    for col, type_code in type_codes.items():
+        if type_code in psycopg2.extensions.DECIMAL.values:
+            df[col] = df[col].map(Decimal, na_action="ignore")
+        elif type_code in _JSON_OIDS:
+            df[col] = df[col].map(json.loads, na_action="ignore")
+    return df
+
+
+def _get_arrow_type(type_code):
+    """Map a PostgreSQL type to the Arrow type used to parse COPY output.
+    """
+    extensions = psycopg2.extensions
+    if type_code in extensions.INTEGER.values + extensions.LONGINTEGER.values:
+        return pa.int64()
+    elif type_code in extensions.FLOAT.values:
+        return pa.float64()
+    elif type_code in extensions.BOOLEAN.values:
+        return pa.bool_()
+    elif type_code in extensions.PYDATETIMETZ.values:
+        return pa.timestamp("us", tz="UTC")
+    elif type_code in extensions.PYDATETIME.values:
+        return pa.timestamp("us")
+    else:
+        return pa.string()
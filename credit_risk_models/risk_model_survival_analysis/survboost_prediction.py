@@ -9,6 +9,9 @@ def main(args):
         prediction_table_name=args.prediction_table_name,
         feat_imps_table_name=args.feat_imps_table_name,
         dpd_limit=args.dpd_limit,
+        n_jobs=args.n_jobs,
+        batch_size=args.batch_size,
+        max_rss_mb=args.max_rss_mb,
     )
     task.run()
 
@@ -20,5 +23,8 @@ if __name__ == "__main__":
     parser.add_argument("--prediction_table_name", type=str)
     parser.add_argument("--feat_imps_table_name", type=str)
     parser.add_argument("--dpd_limit", type=int)
+    parser.add_argument("--n_jobs", type=int, default=None)
+    parser.add_argument("--batch_size", type=int, default=10_000)
+    parser.add_argument("--max_rss_mb", type=float, default=None)
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,48 @@
+import pandas as pd
+
+from credit_risk_models.risk_model_survival_analysis._dtypes import DtypePolicy
+
+
+def test_dtype_policy(tmp_path):
+    chunks = [
+        pd.DataFrame({
+            "carloan_id": ["a", "b", None],
+            "car_make": ["Seat", "Seat", "Fiat"],
+            "loan_n_past_audits": [0, 3, 4],
+            "loan_n_past_audits_30d": [0, 1, 2],
+            "owner_age_year": [40, 50, 60],
+            "loan_ratio_audit_overdue": [0., 0.5, 1.],
+            "observation_date": pd.to_datetime(["2024-01-01"] * 3),
+        }),
+        pd.DataFrame({
+            "carloan_id": ["c"],
+            "car_make": ["Renault"],
+            "loan_n_past_audits": [40_000],
+            "loan_n_past_audits_30d": [10],
+            # A company missing after a left join.
+            "owner_age_year": [None],
+            "loan_ratio_audit_overdue": [0.],
+            "observation_date": pd.to_datetime(["2024-01-01"]),
+        }),
+    ]
+    chunks = [DtypePolicy().apply(chunk) for chunk in chunks]
+
+    # Dtypes don't depend on the values of each chunk.
+    for chunk in chunks:
+        assert chunk.dtypes.to_dict() == {
+            "carloan_id": "string[pyarrow]",
+            "car_make": "string[pyarrow]",
+            "loan_n_past_audits": "int32",
+            "loan_n_past_audits_30d": "int32",
+            "owner_age_year": "float32",
+            "loan_ratio_audit_overdue": "float32",
+            "observation_date": "datetime64[ns]",
+        }
+    assert chunks[0]["carloan_id"].isna().tolist() == [False, False, True]
+
+    # The chunks can be written as Parquet files and read back together.
+    for idx, chunk in enumerate(chunks):
+        chunk.to_parquet(tmp_path / f"part-{idx:05d}.parquet", index=False)
+    df = pd.read_parquet(tmp_path)
+    assert df.shape == (4, 7)
+    assert df["loan_n_past_audits"].tolist() == [0, 3, 4, 40_000]
@@ -0,0 +1,38 @@
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+from credit_risk_models.risk_model_survival_analysis._feature_registry import (
+    EventFeature, aggregate
+)
+
+
+def test_aggregate_windows():
+    audits = pd.DataFrame({
+        "carloan_id": [1, 1, 1, 2],
+        "audit_due_date": pd.to_datetime(
+            ["2022-01-01", "2022-02-15", "2022-03-01", "2022-02-20"]
+        ),
+        "audit_cancelled": [False, False, True, False],
+    })
+    single_obs = pd.DataFrame({
+        "carloan_id": [1, 1, 2, 3],
+        "observation_date": pd.to_datetime(
+            ["2022-02-01", "2022-03-10", "2022-03-10", "2022-03-10"]
+        ),
+    })
+    features = [
+        EventFeature(
+            "loan_n_due", "loan", "audits",
+            date=lambda audits: audits["audit_due_date"],
+            predicate=lambda audits: ~audits["audit_cancelled"],
+            windows=(None, 30),
+        )
+    ]
+
+    expected_single_obs = single_obs.assign(
+        loan_n_due=[1, 2, 1, 0],
+        loan_n_due_30d=[0, 1, 1, 0],
+    )
+    single_obs = aggregate(single_obs, audits, "audits", "loan", features)
+    assert_frame_equal(single_obs, expected_single_obs)
+
@@ -0,0 +1,31 @@
+import numpy as np
+from sklearn.linear_model import Ridge
+
+from credit_risk_models.risk_model_survival_analysis._lime import BatchLimeExplainer
+
+
+def test_batch_lime_explainer():
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(20, 4)) * [1, 2, 3, 4]
+    coef = rng.normal(size=(3, 4))
+
+    def predict_fn(X, times):
+        scores = (X @ coef.T)[:, :, None] + np.asarray(times)[None, None, :] / 100
+        return 1 / (1 + np.exp(-scores))
+
+    horizons = rng.choice([10, 50], size=X.shape[0])
+    labels = rng.choice([0, 2], size=X.shape[0])
+    explainer = BatchLimeExplainer(X, num_samples=500, batch_size=8, random_state=0)
+    contributions = explainer.explain(X, predict_fn, horizons, labels)
+
+    # The local model of LIME, fitted on the same perturbations.
+    for idx in range(X.shape[0]):
+        noise = explainer.noise_ * explainer.scale_ + explainer.mean_
+        data = np.vstack([X[idx], noise])
+        scaled = (data - explainer.mean_) / explainer.scale_
+        distances = np.linalg.norm(scaled - scaled[0], axis=1)
+        weights = np.sqrt(np.exp(-distances ** 2 / explainer.kernel_width ** 2))
+        y = predict_fn(data, [horizons[idx]])[:, labels[idx], 0]
+        ridge = Ridge(alpha=1).fit(scaled, y, sample_weight=weights)
+
+        np.testing.assert_allclose(contributions[idx], ridge.coef_, atol=1e-8)
@@ -1,3 +1,5 @@
+import dataclasses
+
 import pandas as pd
 from pandas.testing import assert_frame_equal
 import pytest
@@ -5,8 +7,10 @@ import pytest
 from credit_risk_models.risk_model_survival_analysis._loans import (
     get_loans, Risks
 )
+from credit_risk_models.risk_model_survival_analysis import _feature_registry
 from credit_risk_models.risk_model_survival_analysis._make_dataset import (
-    _agg_join_audit_loan, _agg_join_audit_dealer, _agg_join_labels_dealer
+    DatasetMaker, _aggregate, _get_audit_indices, _get_dealer_audits,
+    _agg_join_labels_dealer, _get_loan_uniforms, _get_borrower_chunks,
 )
 
 @pytest.fixture
@@ -60,10 +64,14 @@ def sample_audits():
             "2021-01-05", "2022-01-15", "2022-03-15", "2021-06-20",
             "2021-07-05", "2022-06-05", "2022-06-11", None,
         ]),
-        # audits with only 0 are either ongoing or overdue
-        "approved": [1, 0, 1, 0, 0, 0, 1, 0],
-        "rejected": [0, 1, 0, 0, 0, 0, 0, 0],
-        "cancelled": [0, 0, 0, 0, 0, 1, 0, 0],
+        "audit_submission_date": pd.to_datetime([
+            "2021-01-05", "2022-01-15", "2022-03-15", "2021-06-20",
+            "2021-07-05", None, "2022-06-11", None,
+        ]),
+        # audits with only False are either ongoing or overdue
+        "audit_approved": [True, False, True, False, False, False, True, False],
+        "audit_rejected": [False, True, False, False, False, False, False, False],
+        "audit_cancelled": [False, False, False, False, False, True, False, False],
     })
     return audits
 
@@ -75,14 +83,18 @@ def loans():
     return get_loans()
 
 
-def test_agg_join_audit_loan(sample_loans, sample_audits):
-    sample_loans = sample_loans.copy()
-    sample_audits = sample_audits.copy()
-
-    sample_loans["observation_date"] = pd.to_datetime([
+def _aggregate_sample(sample_loans, sample_audits):
+    """Aggregate the sample audits like DatasetMaker, with one observation date
+    per loan.
+    """
+    single_obs = sample_loans.assign(observation_date=pd.to_datetime([
         "2021-01-10", "2022-02-01", "2021-06-30", "2022-07-05",
-    ])
+    ]))
+    dealer_audits = _get_dealer_audits(sample_audits, sample_loans)
+    return _aggregate(single_obs, _get_audit_indices(sample_audits, dealer_audits))
+
 
+def test_aggregate_audit_loan(sample_loans, sample_audits):
     expected_single_obs = pd.DataFrame({
         "borrower_id": [1, 1, 2, 2],
         "carloan_id": [1, 2, 3, 4],
@@ -105,28 +117,22 @@ def test_agg_join_audit_loan(sample_loans, sample_audits):
         "observation_date": pd.to_datetime(
             ["2021-01-10", "2022-02-01", "2021-06-30", "2022-07-05"]
         ),
-        "loan_n_past_audits": [1, 1, 2, 3],
-        "loan_n_audit_late": [0, 0, 1, 1],
+        # The cancelled audit 6 is not counted.
+        "loan_n_past_audits": [1, 1, 2, 2],
+        "loan_n_audit_overdue": [0, 0, 1, 1],
         "loan_n_audit_approved": [1, 0, 0, 1],
         "loan_n_audit_rejected": [0, 1, 0, 0],
-        "loan_ratio_audit_late": [0, 0, 1/2, 1/3],
-        "loan_ratio_audit_approved": [1., 0, 0, 1/3],
+        "loan_ratio_audit_overdue": [0, 0, 1/2, 1/2],
+        "loan_ratio_audit_approved": [1., 0, 0, 1/2],
         "loan_ratio_audit_rejected": [0, 1., 0, 0],
     })
 
-    single_obs = _agg_join_audit_loan(sample_loans, sample_audits)
-
-    assert_frame_equal(single_obs, expected_single_obs)
+    single_obs = _aggregate_sample(sample_loans, sample_audits)
 
+    assert_frame_equal(single_obs[expected_single_obs.columns], expected_single_obs)
 
-def test_agg_join_audit_dealer(sample_loans, sample_audits):
-    sample_loans = sample_loans.copy()
-    sample_audits = sample_audits.copy()
-
-    sample_loans["observation_date"] = pd.to_datetime([
-        "2021-01-10", "2022-02-01", "2021-06-30", "2022-07-05",
-    ])
 
+def test_aggregate_audit_dealer(sample_loans, sample_audits):
     expected_single_obs = pd.DataFrame({
         "borrower_id": [1, 1, 2, 2],
         "carloan_id": [1, 2, 3, 4],
@@ -149,18 +155,19 @@ def test_agg_join_audit_dealer(sample_loans, sample_audits):
         "observation_date": pd.to_datetime(
             ["2021-01-10", "2022-02-01", "2021-06-30", "2022-07-05"]
         ),
-        "dealer_n_past_audits": [1, 2, 2, 5],
+        # The cancelled audit 6 is not counted.
+        "dealer_n_past_audits": [1, 2, 2, 4],
         "dealer_n_audit_overdue": [0, 0, 1, 3],
         "dealer_n_audit_approved": [1, 1, 0, 1],
         "dealer_n_audit_rejected": [0, 1, 0, 0],
-        "dealer_ratio_audit_overdue": [0, 0, 1/2, 3/5],
-        "dealer_ratio_audit_approved": [1, 1/2, 0, 1/5],
+        "dealer_ratio_audit_overdue": [0, 0, 1/2, 3/4],
+        "dealer_ratio_audit_approved": [1, 1/2, 0, 1/4],
         "dealer_ratio_audit_rejected": [0, 1/2, 0, 0],
     })
 
-    single_obs = _agg_join_audit_dealer(sample_loans, sample_audits)
+    single_obs = _aggregate_sample(sample_loans, sample_audits)
 
-    assert_frame_equal(single_obs, expected_single_obs)
+    assert_frame_equal(single_obs[expected_single_obs.columns], expected_single_obs)
 
 
 def test_agg_join_labels_dealer(sample_loans):
@@ -206,3 +213,116 @@ def test_agg_join_labels_dealer(sample_loans):
     single_obs = _agg_join_labels_dealer(sample_loans)
 
     assert_frame_equal(single_obs, expected_single_obs)
+
+
+def test_get_loan_uniforms():
+    carloan_ids = pd.Series(["a", "b", "c", "d"])
+    uniforms = _get_loan_uniforms(carloan_ids, n_draw=1, random_state=42)
+    assert ((uniforms >= 0) & (uniforms < 1)).all()
+
+    # The number of a loan doesn't depend on the other loans.
+    subset = _get_loan_uniforms(carloan_ids[[3, 1]], n_draw=1, random_state=42)
+    assert (subset == uniforms[[3, 1]]).all()
+
+    assert (_get_loan_uniforms(carloan_ids, 2, 42) != uniforms).all()
+    assert (_get_loan_uniforms(carloan_ids, 1, 0) != uniforms).all()
+
+
+def test_get_borrower_chunks():
+    borrower_ids = pd.Series(["a", "b", "a", "c", "b", "d"])
+    n_rows = pd.Series([2, 3, 2, 4, 1, 1])
+
+    # a: 4 rows, b: 4 rows, c: 4 rows, d: 1 row.
+    chunks = _get_borrower_chunks(borrower_ids, n_rows, chunk_rows=5)
+    assert list(chunks) == [0, 1, 0, 2, 1, 2]
+
+
+@pytest.fixture
+def prediction_tables(sample_audits):
+    """The source tables of 3 on-going loans of 2 borrowers, observed today."""
+    today = pd.Timestamp.now().normalize()
+    loans = pd.DataFrame({
+        "borrower_id": ["1", "1", "2"],
+        "carloan_id": [1, 2, 3],
+        "collateral_id": [1, 2, 3],
+        "risks": [Risks.on_going.value] * 3,
+        "loan_duration": [100, 100, 100],
+        "loan_amount": [1000., 2000., 3000.],
+        "loan_created_date": today - pd.to_timedelta([100, 50, 10], unit="D"),
+        "loan_end_date": pd.NaT,
+        "loan_reimbursed_date": pd.NaT,
+    })
+    audits = sample_audits.loc[sample_audits["carloan_id"] < 4].copy()
+    # Audits of the first loan 90, 60, 20 and 5 days ago.
+    audits["carloan_id"] = 1
+    for col in ["audit_scheduled_for_from", "audit_due_date", "audit_submission_date"]:
+        audits[col] = today - pd.to_timedelta([90, 60, 20, 5, 5], unit="D")
+    cars = loans[["carloan_id", "borrower_id", "collateral_id"]].assign(
+        car_make="make", car_model="model", car_transmission_type="manual",
+        car_source="dealer",
+    )
+    companies = pd.DataFrame({
+        "borrower_id": ["1", "2"],
+        "company_registration_number": ["A", "B"],
+        "country_code": ["ES", "ES"],
+        "n_days_since_founded": [1000, 2000],
+        "owner_age_year": [40, 50],
+    })
+    return dict(loans=loans, audits=audits, cars=cars, companies=companies)
+
+
+def test_dataset_window_columns(prediction_tables, monkeypatch):
+    features = [
+        dataclasses.replace(feature, windows=(None, 30))
+        if feature.name == "loan_n_past_audits" else feature
+        for feature in _feature_registry.FEATURES
+    ]
+    monkeypatch.setattr(_feature_registry, "FEATURES", features)
+
+    ds = DatasetMaker(is_training=False, verbose=False)
+    ds.__dict__.update(prediction_tables)
+    dataset = ds.dataset
+
+    assert list(dataset["loan_n_past_audits"]) == [5, 0, 0]
+    assert list(dataset["loan_n_past_audits_30d"]) == [3, 0, 0]
+
+
+def test_iter_dataset_prediction(prediction_tables):
+    ds = DatasetMaker(is_training=False, verbose=False)
+    ds.__dict__.update(prediction_tables)
+    chunks = list(ds.iter_dataset(chunk_rows=1))
+
+    # The loans of a borrower are in the same chunk, and the chunks are observed
+    # at the same date as the dataset.
+    assert [chunk["carloan_id"].tolist() for chunk in chunks] == [[1, 2], [3]]
+    assert_frame_equal(pd.concat(chunks, ignore_index=True), ds.dataset)
+
+
+def test_write_dataset_missing_company(prediction_tables, tmp_path):
+    # The borrower of the first chunk has no company data.
+    companies = prediction_tables["companies"]
+    prediction_tables["companies"] = companies.loc[companies["borrower_id"] == "2"]
+
+    ds = DatasetMaker(is_training=False, verbose=False)
+    ds.__dict__.update(prediction_tables)
+    paths = ds.write_dataset(tmp_path, chunk_rows=1)
+
+    # The chunks are written with the same schema and can be read back together.
+    assert len(paths) == 2
+    dataset = pd.read_parquet(tmp_path)
+    assert dataset["country_code"].tolist() == [None, None, "ES"]
+    assert dataset["owner_age_year"].tolist()[2] == 50
+
+
+def test_sample_dataset(prediction_tables):
+    ds = DatasetMaker(is_training=False, verbose=False)
+    ds.__dict__.update(prediction_tables)
+    dataset = ds.dataset.set_index("carloan_id")
+
+    # Borrowers are drawn with all their loans, until their loans reach n_rows.
+    sample = ds.sample_dataset(n_rows=1)
+    assert sample["borrower_id"].nunique() == 1
+    expected = dataset.loc[sample["carloan_id"]].reset_index()
+    assert_frame_equal(sample, expected)
+
+    assert ds.sample_dataset(n_rows=3)["carloan_id"].tolist() == [1, 2, 3]
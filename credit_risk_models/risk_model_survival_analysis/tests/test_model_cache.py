@@ -0,0 +1,37 @@
+from credit_risk_models.risk_model_survival_analysis._model_cache import ModelCache
+
+
+def _make_download(content, calls):
+    def download(download_dir):
+        calls.append(download_dir)
+        path = download_dir + "/model.pkl"
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+    return download
+
+
+def test_model_cache(tmp_path):
+    cache = ModelCache(cache_dir=str(tmp_path), max_versions=2)
+    calls = []
+
+    path = cache.get("model", "1", _make_download(b"v1", calls))
+    assert path.read_bytes() == b"v1"
+    assert len(calls) == 1
+
+    # A verified copy is not downloaded again.
+    assert cache.get("model", "1", _make_download(b"v1", calls)) == path
+    assert len(calls) == 1
+
+    # A corrupted copy is downloaded again.
+    path.write_bytes(b"corrupted")
+    path = cache.get("model", "1", _make_download(b"v1", calls))
+    assert path.read_bytes() == b"v1"
+    assert len(calls) == 2
+
+    # Only the 2 most recently used versions are kept.
+    path_2 = cache.get("model", "2", _make_download(b"v2", calls))
+    cache.get("model", "3", _make_download(b"v3", calls))
+    assert not path.exists()
+    assert path_2.exists()
+    assert len(list((tmp_path / "manifests").glob("*.json"))) == 2
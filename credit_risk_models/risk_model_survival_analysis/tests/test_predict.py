@@ -0,0 +1,200 @@
+import pickle
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.base import BaseEstimator
+
+from credit_risk_models.risk_model_survival_analysis import _lime
+from credit_risk_models.risk_model_survival_analysis import _predict
+from credit_risk_models.risk_model_survival_analysis._predict import (
+    PredictTask, _explain_parallel, _get_explain_executor
+)
+
+
+class LogisticIncidence(BaseEstimator):
+    """A picklable model of the cumulative incidence of 3 events."""
+
+    def __init__(self, show_progressbar=True):
+        self.show_progressbar = show_progressbar
+
+    def fit(self, X, y=None):
+        n_features = np.asarray(X).shape[1]
+        self.coef_ = np.linspace(-1, 1, 3 * n_features).reshape(3, n_features)
+        self.time_grid_ = np.linspace(0, 150, 16)
+        return self
+
+    def predict_cumulative_incidence(self, X, times):
+        X = np.asarray(X, dtype="float64")
+        scores = (X @ self.coef_.T)[:, :, None] + np.asarray(times)[None, None, :] / 100
+        return 1 / (1 + np.exp(-scores))
+
+
+class FloatVectorizer:
+    def transform(self, X):
+        return X.astype("float64")
+
+
+def test_explain_parallel(tmp_path):
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(30, 4))
+    horizons = rng.choice([10, 50, 90], size=X.shape[0])
+    labels = rng.choice([0, 2], size=X.shape[0])
+
+    # The model is loaded from the last step of the pickled pipeline.
+    estimator = LogisticIncidence().fit(X)
+    model_path = tmp_path / "model.pkl"
+    with open(model_path, "wb") as f:
+        pickle.dump([FloatVectorizer(), estimator], f)
+
+    explainer = _lime.BatchLimeExplainer(X, num_samples=500, random_state=0)
+    contributions = []
+    with _get_explain_executor(model_path, explainer, n_jobs=2) as executor:
+        # Explain in 1 and 2 shards.
+        for n_jobs in [1, 2]:
+            contributions.append(
+                _explain_parallel(X, horizons, labels, executor, n_jobs=n_jobs)
+            )
+
+    # Explanations don't depend on the number of workers.
+    expected = explainer.explain(
+        X, estimator.predict_cumulative_incidence, horizons, labels
+    )
+    for result in contributions:
+        np.testing.assert_allclose(result, expected)
+
+
+@pytest.fixture
+def predict_task(monkeypatch):
+    """A PredictTask on 25 on-going loans, recording the batches it writes."""
+    rng = np.random.default_rng(0)
+    dataset = pd.DataFrame({
+        "carloan_id": [f"loan_{idx}" for idx in range(25)],
+        "borrower_id": "borrower",
+        "event": 0,
+        "duration": 30,
+        "loan_age_days": rng.integers(0, 150, size=25),
+        "loan_amount": rng.uniform(1, 10, size=25),
+    })
+
+    class ChunkedDatasetMaker:
+        # The full dataset is not available, only its chunks.
+        def __init__(self, is_training):
+            assert not is_training
+
+        def prefetch(self, tables):
+            return self
+
+        def iter_dataset(self, chunk_rows):
+            for start in range(0, dataset.shape[0], chunk_rows):
+                yield dataset.iloc[start:start + chunk_rows]
+
+        def sample_dataset(self, n_rows):
+            return dataset.sample(min(n_rows, dataset.shape[0]), random_state=0)
+
+    estimator = LogisticIncidence().fit(dataset[["loan_age_days", "loan_amount"]])
+    model_dict = dict(
+        model=[FloatVectorizer(), estimator],
+        model_path=None,
+        model_name="model",
+        model_version="1",
+    )
+    calls = []
+
+    class RecordingDBSourceRisk:
+        # Staging table names end with the random batch id.
+        def write_df(self, df, table_name, if_exists, **kwargs):
+            table_name = table_name.rsplit("_", 1)[0]
+            calls.append(("write", table_name, df.shape[0], if_exists))
+
+        def delete(self, table_name, schema, missing_ok):
+            calls.append(("delete", table_name.rsplit("_", 1)[0]))
+
+        def replace_tables(self, tables, schema):
+            for table_name, staging_name in tables.items():
+                calls.append(("replace", table_name, staging_name.rsplit("_", 1)[0]))
+
+    monkeypatch.setattr(_predict._make_dataset, "DatasetMaker", ChunkedDatasetMaker)
+    monkeypatch.setattr(_predict, "_load_model", lambda *args, **kwargs: model_dict)
+    monkeypatch.setattr(_predict.db, "DBSourceRisk", RecordingDBSourceRisk)
+
+    task = PredictTask(
+        "model", "1", "predictions", "feat_imps", random_state=0, batch_size=10
+    )
+    return task, calls
+
+
+def test_predict_task_batches(predict_task):
+    task, calls = predict_task
+    task.run()
+
+    # Predictions and feature importances (2 features per loan) are written batch
+    # by batch to staging tables, which then replace the tables.
+    assert calls == [
+        ("write", "predictions_staging", 10, "replace"),
+        ("write", "feat_imps_staging", 20, "replace"),
+        ("write", "predictions_staging", 10, "append"),
+        ("write", "feat_imps_staging", 20, "append"),
+        ("write", "predictions_staging", 5, "append"),
+        ("write", "feat_imps_staging", 10, "append"),
+        ("replace", "predictions", "predictions_staging"),
+        ("replace", "feat_imps", "feat_imps_staging"),
+    ]
+
+
+def test_predict_task_max_rss(predict_task):
+    task, calls = predict_task
+    task.max_rss_mb = 1
+
+    with pytest.raises(MemoryError, match="Reduce batch_size"):
+        task.run()
+
+    # The run stops before writing the first batch, and the tables are unchanged.
+    assert calls == [
+        ("delete", "predictions_staging"),
+        ("delete", "feat_imps_staging"),
+    ]
+
+
+def test_predict_task_lime_sample(predict_task, monkeypatch):
+    task, _ = predict_task
+    explainers = []
+
+    class RecordingExplainer(_lime.BatchLimeExplainer):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            explainers.append(self)
+
+    monkeypatch.setattr(_predict._lime, "BatchLimeExplainer", RecordingExplainer)
+    for batch_size in [10, 25]:
+        task.batch_size = batch_size
+        task.run()
+
+    # The perturbations are scaled by the statistics of a sample of all the loans,
+    # which don't depend on the batches.
+    assert explainers[0].mean_ == pytest.approx(explainers[1].mean_)
+    assert explainers[0].scale_ == pytest.approx(explainers[1].scale_)
+
+
+def test_predict_task_loads_model_in_background(predict_task, monkeypatch):
+    task, calls = predict_task
+    model_dict = _predict._load_model()
+    is_featurized = threading.Event()
+
+    class SignalingDatasetMaker(_predict._make_dataset.DatasetMaker):
+        def iter_dataset(self, chunk_rows):
+            for chunk in super().iter_dataset(chunk_rows):
+                is_featurized.set()
+                yield chunk
+
+    def load_model(*args, **kwargs):
+        # The first batch is featurized while the model is loading.
+        assert is_featurized.wait(timeout=10)
+        return model_dict
+
+    monkeypatch.setattr(_predict._make_dataset, "DatasetMaker", SignalingDatasetMaker)
+    monkeypatch.setattr(_predict, "_load_model", load_model)
+    task.run()
+
+    assert calls[-1] == ("replace", "feat_imps", "feat_imps_staging")
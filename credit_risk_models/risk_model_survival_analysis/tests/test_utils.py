@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+from sklearn.base import BaseEstimator
+
+from credit_risk_models.risk_model_survival_analysis._utils import predict_at_horizons
+
+
+class _LinearIncidence(BaseEstimator):
+    """The incidence of event k at time t is k * t * x / 1000."""
+
+    def fit(self, X, y=None):
+        self.time_grid_ = np.array([0.0, 10.0, 20.0, 40.0])
+        return self
+
+    def predict_cumulative_incidence(self, X, times=None):
+        times = self.time_grid_ if times is None else np.asarray(times)
+        x = np.asarray(X)[:, 0]
+        events = np.arange(3)
+        return x[:, None, None] * events[None, :, None] * times[None, None, :] / 1000
+
+
+def test_predict_at_horizons():
+    estimator = _LinearIncidence().fit(None)
+    X = pd.DataFrame({"x": [1.0, 2.0, 3.0, 4.0, 5.0]})
+    horizons = np.array([0, 15, 40, 30, 100])
+
+    y_proba = predict_at_horizons(estimator, X, horizons)
+
+    assert y_proba.dtype == np.float32
+    assert y_proba.shape == (5, 3)
+    # Beyond the grid, the last grid point is used.
+    expected_times = np.array([0, 15, 40, 30, 40])
+    expected = (
+        X["x"].to_numpy()[:, None] * np.arange(3)[None, :]
+        * expected_times[:, None] / 1000
+    )
+    np.testing.assert_allclose(y_proba, expected, rtol=1e-6)